@@ -17,17 +17,14 @@
 # [START sheets_quickstart]
 
 from __future__ import print_function
-from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
+import sheets_client
 import datetime
 import lcd_i2c
+from lcd_display import LCDDisplay
 import Adafruit_BBIO.GPIO as GPIO
 import time
 from time import sleep
-
-# If modifying these scopes, delete the file token.json.
-SCOPES = 'https://www.googleapis.com/auth/spreadsheets'
+from sheets_batch import BatchWriter
 
 # The ID and range of a sample spreadsheet.
 SPREADSHEET_ID = '1Z_nyIw9YRsSfhzw1bcWjpTQoUCObXyeENp-uIwkNCtg'
@@ -44,14 +41,12 @@ column = ["C", "D", "E", "F", "G", "L", "M", "N", "O", "P", "Q", "R", "S", "T",
 row = ''
 
 old_switch_state = 0
+lcd = LCDDisplay(lcd_i2c)
 name_count = 0
 
-store = file.Storage('tokenPython.json')
-creds = store.get()
-if not creds or creds.invalid:
-    flow = client.flow_from_clientsecrets('credentials.json', SCOPES)
-    creds = tools.run_flow(flow, store)
-service = build('sheets', 'v4', http=creds.authorize(Http()))
+creds = sheets_client.load_credentials()
+service = sheets_client.build_service(creds)
+batch_writer = BatchWriter(service, SPREADSHEET_ID)
 
 
 def button_release(channel):
@@ -73,32 +68,25 @@ def button_release(channel):
         update(service)
     elif button_time < 2:
         name_string = names[name_count]
-        lcd_i2c.lcd_string(name_string, lcd_i2c.LCD_LINE_1)
+        lcd.write(name_string, lcd_i2c.LCD_LINE_1)
         RANGE_NAME = column[name_count] + row
-        if name_count < 15:
-            name_count += 1
-        else:
-            name_count = 0
+        name_count = (name_count + 1) % len(names)
         print("Button pressed ")
 
 
 def update(service):
     """Shows basic usage of the Sheets API.
-    Writes values to a sample spreadsheet.
+    Queues a mark for the current cell on the batch writer.
     """
+    batch_writer.submit(RANGE_NAME, 1, on_ack=update_acked, on_fail=update_failed)
+
+
+def update_acked(cell_range, response):
+    print('Updated ' + cell_range)
+
 
-    # Call the Sheets API
-    # Compute a timestamp and pass the first two arguments
-    values = [[1]]
-    body = {'values': values}
-    result = service.spreadsheets().values().update(spreadsheetId=SPREADSHEET_ID,
-                                                    range=RANGE_NAME,
-                                                    #  How the input data should be interpreted.
-                                                    valueInputOption='USER_ENTERED',
-                                                    # How the input data should be inserted.
-                                                    # insertDataOption='INSERT_ROWS'
-                                                    body=body
-                                                    ).execute()
+def update_failed(cell_range, error):
+    print('Update of ' + cell_range + ' failed: ' + str(error))
 
 
 def read_cell_dates(service):
@@ -113,6 +101,7 @@ def app_init():
     GPIO.add_event_detect("P8_12", GPIO.RISING, callback=button_release, bouncetime=500)
 
     lcd_i2c.lcd_init()
+    lcd.reset()
 
 def main():
     global RANGE_NAME
@@ -187,4 +176,5 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         pass
     finally:
+        batch_writer.close()
         lcd_i2c.lcd_byte(0x01, lcd_i2c.LCD_CMD)
@@ -17,13 +17,13 @@
 # [START sheets_quickstart]
 
 from __future__ import print_function
-from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
+import argparse
+import sheets_client
 import datetime
-
-# If modifying these scopes, delete the file token.json.
-SCOPES = 'https://www.googleapis.com/auth/spreadsheets'
+import sys
+from roster import Roster
+from roster_index import RosterIndex
+from sheets_batch import BatchWriter
 
 # The ID and range of a sample spreadsheet.
 SPREADSHEET_ID = '1Z_nyIw9YRsSfhzw1bcWjpTQoUCObXyeENp-uIwkNCtg'
@@ -36,24 +36,22 @@ names = {"Monica": "C", "Elaine": "D", "Na": "E", "Leah": "F", "Avril": "G", "Je
          "Lucas": "O", "Austen": "P", "Haniel": "Q", "Max": "R", "Derrick": "S", "Andrew": "T", "Alan": "U",
          "Siyuan": "V"}
 
+roster = RosterIndex(names)
+
 
-def update(service):
+def update(batch_writer):
     """Shows basic usage of the Sheets API.
-    Writes values to a sample spreadsheet.
+    Queues a mark for the current cell on the batch writer.
     """
+    batch_writer.submit(RANGE_NAME, 1, on_ack=update_acked, on_fail=update_failed)
+
+
+def update_acked(cell_range, response):
+    print('Updated ' + cell_range)
 
-    # Call the Sheets API
-    # Compute a timestamp and pass the first two arguments
-    values = [[1]]
-    body = {'values': values}
-    result = service.spreadsheets().values().update(spreadsheetId=SPREADSHEET_ID,
-                                                    range=RANGE_NAME,
-                                                    #  How the input data should be interpreted.
-                                                    valueInputOption='USER_ENTERED',
-                                                    # How the input data should be inserted.
-                                                    # insertDataOption='INSERT_ROWS'
-                                                    body=body
-                                                    ).execute()
+
+def update_failed(cell_range, error):
+    print('Update of ' + cell_range + ' failed: ' + str(error))
 
 
 def read_cell_dates(service):
@@ -63,20 +61,87 @@ def read_cell_dates(service):
     return dates
 
 
+def load_roster(service):
+    # The sheet's header row replaces the names above when it can be read
+    global names
+    global roster
+
+    header = Roster(SPREADSHEET_ID, list(names), list(names.values()))
+    header.load()
+    try:
+        header.refresh(service)
+    except Exception as e:
+        print('Could not read the roster (' + str(e) + '), using ' + str(len(header)) + ' saved names')
+    names = dict(zip(header.names, header.columns))
+    roster = RosterIndex(names)
+
+
+def resolve_name(name):
+    """Column letter for a (partial or misspelled) name, None if unclear."""
+    match, candidates = roster.resolve(name)
+    if match is not None:
+        if match != name:
+            print(name + ' -> ' + match)
+        return names[match]
+    if candidates:
+        print('Did you mean: ' + ', '.join(candidates) + '?')
+    else:
+        print('No student with that name. ')
+    return None
+
+
+def read_roll(path):
+    # One name per line (or comma separated); '-' reads stdin
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for line in f:
+            for name in line.split(','):
+                name = name.strip()
+                if name and not name.startswith('#'):
+                    yield name
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def submit_roll(batch_writer, row, path):
+    """Mark every name in the roll with one batched write."""
+    global RANGE_NAME
+
+    unresolved = []
+    for name in read_roll(path):
+        column = resolve_name(name)
+        if column is None:
+            unresolved.append(name)
+            continue
+        RANGE_NAME = column + row
+        update(batch_writer)
+
+    print('Sending ' + str(batch_writer.pending_count()) + ' marks')
+    # flush() returns once the batchUpdate has been acknowledged or failed
+    batch_writer.close()
+    if unresolved:
+        print('Not marked: ' + ', '.join(unresolved))
+    return not unresolved
+
+
 def main():
     global RANGE_NAME
 
+    parser = argparse.ArgumentParser(description='Mark attendance from the command line')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='mark every name in FILE (one per line, - for stdin) with one write')
+    args = parser.parse_args()
+
     is_lesson = False
 
     time = datetime.datetime.now()
     time_str = time.strftime("%m/%d/%Y")
 
-    store = file.Storage('tokenPython.json')
-    creds = store.get()
-    if not creds or creds.invalid:
-        flow = client.flow_from_clientsecrets('credentials.json', SCOPES)
-        creds = tools.run_flow(flow, store)
-    service = build('sheets', 'v4', http=creds.authorize(Http()))
+    creds = sheets_client.load_credentials()
+    service = sheets_client.build_service(creds)
+    batch_writer = BatchWriter(service, SPREADSHEET_ID)
+    load_roster(service)
 
     date_list = read_cell_dates(service)
 
@@ -89,6 +154,12 @@ def main():
                 # print(row)
                 is_lesson = True
 
+    if args.batch is not None:
+        if not is_lesson:
+            print('No lesson today, nothing marked')
+            sys.exit(1)
+        sys.exit(0 if submit_roll(batch_writer, row, args.batch) else 1)
+
     if not is_lesson:
         print('No lesson today, continue or press q to quit ')
         next = input()
@@ -100,22 +171,17 @@ def main():
         # print('Enter term number: ')
         # term = input()
 
-        name_check = False
-
         print('Enter student name: ')
         name = input()
 
         if name == 'q':
+            batch_writer.close()
             exit()
 
-        for key, value in names.items():
-            if key == name:
-                name_check = True
-                RANGE_NAME = value + row
-                update(service)
-
-        if not name_check:
-            print('No student with that name. ')
+        column = resolve_name(name)
+        if column is not None:
+            RANGE_NAME = column + row
+            update(batch_writer)
 
 
 if __name__ == '__main__':
@@ -17,30 +17,46 @@
 # [START sheets_quickstart]
 
 from __future__ import print_function
-from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
+import sheets_client
+from sheets_client import StartupTimer
 import datetime
-import pyinotify
 import lcd_i2c
+from lcd_display import LCDDisplay
 import Adafruit_BBIO.GPIO as GPIO
+import os
 import time
-from time import sleep
 import sys
-import signal
-from contextlib import contextmanager
 import logging
-from timeout import timeout 
-
-logging.basicConfig(filename='app.log', filemode='w', level=logging.DEBUG)
-logging.warning('This will get logged to a file')
+import log_setup
+from sheets_batch import BatchWriter
+from aggregator import AGGREGATOR_ENV, TOKEN_ENV, AggregatorClient, AggregatorService, parse_address
+from journal import Journal, JournalReplayer
+from async_runtime import ButtonRuntime
+from lesson_calendar import LessonCalendar
+from roster import Roster
+import gestures
+from reconnect import CircuitBreaker, is_rejected, is_throttled
+from deadline import deadline
+from sheets_scheduler import BACKGROUND, MARK, SheetsScheduler, lane
+from led_controller import LEDController
+import metrics
+from attendance_store import AttendanceStore
+from sync_engine import SyncEngine
+import threading
+
+# Google client imports are deferred to sheets_client so the LCD and
+# buttons come up before they are loaded
+# The session thread marks service and connected after main() is ready;
+# the line goes to startup.log once both sides are done
+startup = StartupTimer(until=('ready', 'connected'))
+
+# Queued, batched writes to a rotating app.log; earlier boots are kept
+log_setup.configure()
+logging.info('Attendance logger starting')
 
 redLEDPath = '/sys/class/gpio/gpio45/value'
 greenLEDPath = '/sys/class/gpio/gpio69/value'
 
-# If modifying these scopes, delete the file token.json.
-SCOPES = 'https://www.googleapis.com/auth/spreadsheets'
-
 # The ID and range of a sample spreadsheet.
 SPREADSHEET_ID = '1NrjRyLdJXOv9Sv5fL32aeQTmobcZ_M9Gj3vp1jX9sgM'
 RANGE_NAME = 'A2'
@@ -55,246 +71,296 @@ names = ["Michelle", "Vivian", "Monica", "Elaine", "Na", "Leah", "Ann Qing", "Lo
 column = ["C", "D", "E", "F", "G", "H", "I", "L", "M", "N", "O", "P", "Q", "R", "S", "T", "U", "V"]
 row = ''
 
+# The sheet's header row is the roster; the lists above are only used
+# until it has been read once. A cached header is used straight away.
+roster = Roster(SPREADSHEET_ID, names, column)
+roster.load()
+names = roster.names
+column = roster.columns
+# Held while names/column are swapped for a new roster
+roster_lock = threading.Lock()
+shown_name = None
+# Turns presses into scroll, jump and mark-and-advance moves; it keeps
+# the position of the name on screen
+presses = gestures.GestureEngine(names)
+
 lcd_call = 0
+lcd = LCDDisplay(lcd_i2c, bulk=True)
+
+# Request deadlines in seconds (marks use the batch writer's timeout)
+PROBE_TIMEOUT = 3
+CALENDAR_TIMEOUT = 10
+ROSTER_TIMEOUT = 10
+# Seconds between checks of the header row for roster changes
+ROSTER_INTERVAL = 600
 
 scroll_path = "/sys/logger/gpio44/"
 update_path = "/sys/logger/gpio68/"
 
 old_switch_state = 0
-name_count = 0
 
 
-def turn_green_on():
-    f = open(greenLEDPath, 'w+')
-    f.write("1\n")
-    f.close()
+# Opened in app_init(); patterns play on the controller's own thread
+leds = None
 
 
-def turn_green_off():
-    f = open(greenLEDPath, 'w+')
-    f.write("0\n")
-    f.close()
+def ack_led():
+    logging.debug('Ack')
+    leds.play('ack')
+
+
+def fail_led():
+    leds.play('fail')
+
+
+def update_status_led():
+    # Background pattern: offline (with the queue depth), syncing or off
+    pending = journal.pending_count()
+    if breaker.is_open():
+        if pending:
+            leds.set_background('pending', pending)
+        else:
+            leds.set_background('offline')
+    elif pending:
+        leds.set_background('syncing')
+    else:
+        leds.set_background(None)
+
+
+creds = None
+token_refresher = None
+http_pool = None
+service = None
+# Every Sheets request is paced to the quota, marks ahead of reads
+scheduler = SheetsScheduler()
+
+aggregated = bool(os.environ.get(AGGREGATOR_ENV))
+if aggregated:
+    # Marks and reads go through the classroom aggregator, which batches
+    # them with the other rooms' on one shared Sheets client
+    batch_writer = AggregatorClient(parse_address(os.environ[AGGREGATOR_ENV]), SPREADSHEET_ID,
+                                    token=os.environ.get(TOKEN_ENV))
+else:
+    batch_writer = BatchWriter(service, SPREADSHEET_ID)
+journal = Journal()
+calendar = LessonCalendar(SPREADSHEET_ID)
+# Local copy of the term's marks, one bit per student per lesson
+store = AttendanceStore(names, column)
+
+
+def probe_sheets():
+    # Cheap liveness check (a ping to the aggregator when there is one);
+    # the service itself never needs rebuilding
+    with deadline(PROBE_TIMEOUT), lane(MARK):
+        try:
+            service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID, fields='spreadsheetId').execute()
+        except Exception as e:
+            # Over quota still means the API is reachable
+            if not is_throttled(e):
+                raise
 
 
-def turn_red_on():
-    f = open(redLEDPath, 'w+')
-    f.write("1\n")
-    f.close()
+def connection_lost():
+    print('No connection..')
+    update_status_led()
 
 
-def turn_red_off():
-    f = open(redLEDPath, 'w+')
-    f.write("0\n")
-    f.close()
+def connection_restored():
+    ack_led()
+    update_status_led()
+    logging.debug('Connected ')
+    print('Replaying pending marks')
+    logging.debug('Replaying %d pending marks..', journal.pending_count())
+    replayer.kick()
 
 
-def ack_led():
-    logging.debug('Ack')
-    turn_green_on()
-    sleep(0.2)
-    turn_green_off()
-    sleep(0.2)
-    turn_green_on()
-    sleep(0.2)
-    turn_green_off()
+# Presses keep working (and are journaled) while the breaker is open
+breaker = CircuitBreaker(probe_sheets, on_open=connection_lost, on_close=connection_restored)
+batch_writer.gate = lambda: service is not None and breaker.allow_request()
 
 
-def fail_led():
-    turn_red_on()
-    sleep(1)
-    turn_red_off()
-
-
-store = file.Storage('tokenPython.json')
-creds = store.get()
-if not creds or creds.invalid:
-    flow = client.flow_from_clientsecrets('credentials.json', SCOPES)
-    creds = tools.run_flow(flow, store)
-connection = False
-try:
-    service = build('sheets', 'v4', http=creds.authorize(Http()))
+def update_acked(cell_range, response):
     ack_led()
-except:
-    print('No connection ')
-    logging.warning('No connection')
-    pass
+    update_status_led()
+    logging.debug('Update success.. ' + cell_range)
+    print("Update success.. ")
 
-while not connection:
-    try:
-        service = build('sheets', 'v4', http=creds.authorize(Http()))
-        connection = True
-        ack_led()
-        logging.debug('Connected ')
-    except:
-        print('No connection ')
-        logging.warning('No connection')
-        turn_red_on()
-        sleep(1)
-        turn_red_off()
-        sleep(1)
-        pass
-
-
-
-@contextmanager
-def timeout(time):
-    signal.signal(signal.SIGALRM, raise_timeout)
-    signal.alarm(time)
-    try:
-        yield
-    except TimeoutError:
-        pass
-    finally:
-        signal.signal(signal.SIGALRM, signal.SIG_IGN)
 
+def correction_acked(cell_range, response):
+    ack_led()
+    update_status_led()
+    logging.debug('Correction made.. ' + cell_range)
+    print("Correction made..")
+
+
+def write_failed(cell_range, error):
+    logging.debug('Write to ' + cell_range + ' failed: ' + str(error))
+    if is_throttled(error):
+        # Over quota, not offline: the mark stays journaled and is resent
+        # once the bucket has tokens again; the breaker is left alone
+        replayer.kick_after(scheduler.throttled_for())
+        update_status_led()
+    elif is_rejected(error):
+        # The replayer has dead-lettered it; nothing is left to resend
+        fail_led()
+        update_status_led()
+    else:
+        # Offline, an expired token or anything unexpected: the mark stays
+        # journaled and is replayed once the breaker's probe gets through
+        breaker.record_failure(error)
+        update_status_led()
 
-def raise_timeout(signum, frame):
-    raise TimeoutError
 
+# Marks that fail stay in the journal and are resent by the replayer
+replayer = JournalReplayer(journal, batch_writer, on_fail=write_failed)
+# Periodic read-back of the attendance block; hand edits come into the store
+sync = SyncEngine(service, SPREADSHEET_ID, store, replayer)
+sync.gate = batch_writer.gate
 
-def try_connect():
-    global connection
-    global service
-    logging.debug('Trying to reconnect...')
-    while not connection:
-        try:
-            service = build('sheets', 'v4', http=creds.authorize(Http()))
-            logging.debug(service)
-            connection = True
-            ack_led()
-            logging.debug('Connected ')
-            print('Update failed')
-            logging.debug('Update failed..')
-            fail_led()
-        except:
-            print('No connection..')
-            logging.warning('No connection')
-            turn_red_on()
-            sleep(1)
-            turn_red_off()
-            sleep(1)
-            pass
+MARKS = metrics.counter('marks_total', 'Marks and corrections recorded', ('value',))
+QUEUE_DEPTH = metrics.gauge('queue_depth', 'Items waiting in each queue', ('queue',))
+QUEUE_DEPTH.labels('journal').set_function(journal.pending_count)
+QUEUE_DEPTH.labels('batch').set_function(batch_writer.pending_count)
+QUEUE_DEPTH.labels('scheduler').set_function(scheduler.queued)
+# metrics.prom is rewritten and a summary logged once a minute
+exporter = metrics.Exporter()
 
 
-def update_button():
+def update_button(button_time):
     global service
-    global name_count
     global RANGE_NAME
     global row
     global lcd_call
-    global connection
-    
-    f = open(update_path + "pressTime", "r")
 
-    button_string = f.read()
-    button_time = int(button_string)
+    # The hold time is sampled once by the runtime when the press arrives
+    if button_time is None:
+        logging.warning('Update press with unreadable hold time ignored')
+        return
 
     if button_time >= 1 and row != '':
         # callback to flash LED
         if lcd_call != 0:
-            try:
-                correct(service)
-                # value = read_cell_name(service)
-                # callback for ACK LED if corrected
-                # callback for fail LED if not corrected
-                # print(value[0][0])
-                # if value[0][0] == "0":
-                ack_led()
-                logging.debug('Correction made.. ')
-                print("Correction made..")
-                # else:
-                    # fail_led()
-                    # print("Correction failed.. ")
-            except Exception:              
-                connection = False
-                logging.debug('Lost connection..')
-                try_connect()
+            # ack/fail LEDs are driven per cell once the batch is sent
+            correct(service)
+            # value = read_cell_name(service)
+            # if value[0][0] == "0":
     elif button_time < 1 and row != '':
         if lcd_call !=0:
-            try:
-                update(service)
-                #value = read_cell_name(service)
-                # callback for ACK LED if updated
-                # callback for fail LED if not updated
-                # print(type(value[0][0]))
-                # if value[0][0] == "1":
-                ack_led()
-                logging.debug('Update success..')
-                print("Update success.. ")
-                #else:
-                    #fail_led()
-                    #print("Update failed.. ")
-            except Exception:
-                connection = False
-                logging.debug('Lost connection..')
-                try_connect()
+            update(service)
+            #value = read_cell_name(service)
+            # if value[0][0] == "1":
 
 
 def app_init():
+    global leds
+
+    leds = LEDController(redLEDPath, greenLEDPath)
+    leds.start()
     lcd_i2c.lcd_init()
+    lcd.reset()
+    # Marks left over from before the last shutdown are drained once connected
+    replayer.start()
     logging.debug('initializing app ')
 
 
 
 
-def leds_off():
-    turn_red_off()
-    turn_green_off()
-
-
-def scroll_button():
-    global service
-    global name_count
+def show_student(index):
+    # Point the next mark at students[index]; callers hold roster_lock.
+    # index is None when the roster is empty: nothing to show or mark
     global RANGE_NAME
-    global row
     global lcd_call
+    global shown_name
 
-    name_string = names[name_count]
-    lcd_i2c.lcd_string(name_string, lcd_i2c.LCD_LINE_1)
+    if index is None:
+        return None
+    name_string = names[index]
+    RANGE_NAME = column[index] + row
+    shown_name = name_string
     lcd_call += 1
-    RANGE_NAME = column[name_count] + row
-    if name_count < 15:
-        name_count += 1
-    else:
-        name_count = 0
+    return name_string
+
+
+def next_name():
+    with roster_lock:
+        name_string = show_student(presses.step())
     logging.debug('Scroll press')
     print("Button pressed ")
+    return name_string
+
+
+def jump_group():
+    with roster_lock:
+        name_string = show_student(presses.jump())
+    logging.debug('Jump to %s', name_string)
+    return name_string
+
+
+def reverse_scroll():
+    with roster_lock:
+        name_string = show_student(presses.reverse())
+    logging.debug('Scrolling ' + ('forwards' if presses.direction > 0 else 'backwards'))
+    return name_string
+
+
+def scroll_gesture(event):
+    """Handle a scroll press; returns the name to draw, or None."""
+    gesture = presses.classify(event)
+    if gesture == gestures.STEP:
+        return next_name()
+    if gesture == gestures.JUMP:
+        return jump_group()
+    if gesture == gestures.REVERSE:
+        return reverse_scroll()
+    logging.warning('Scroll press with unreadable hold time ignored')
+    return None
+
+
+def update_gesture(event):
+    """Handle an update press; returns the next name to draw, or None."""
+    gesture = presses.classify(event)
+    marking = gesture == gestures.MARK and row != '' and lcd_call != 0
+    update_button(event.hold)
+    if marking:
+        # Mark and advance: the next student is up without a scroll press
+        with roster_lock:
+            return show_student(presses.step())
+    return None
+
+
+def show_name(name_string):
+    # Only the characters that differ from the previous name are sent
+    try:
+        lcd.write(name_string, lcd_i2c.LCD_LINE_1)
+    except OSError:
+        # An I2C error can leave a line half written; redraw it in full next time
+        lcd.invalidate()
+        raise
+
+
+def record_locally(cell_range, present):
+    # Mirror a mark into the store so totals are answered without Sheets;
+    # through the sync engine, which may be merging into it right now
+    sync.record_local(cell_range, present)
 
 
 def update(service):
     """Shows basic usage of the Sheets API.
-    Writes values to a sample spreadsheet.
+    Queues a mark for the current cell on the batch writer.
     """
-    with timeout(5):
-        # Call the Sheets API
-        # Compute a timestamp and pass the first two arguments
-        logging.debug('Updating..')
-        values = [[1]]
-        body = {'values': values}
-        result = service.spreadsheets().values().update(spreadsheetId=SPREADSHEET_ID,
-                                                    range=RANGE_NAME,
-                                                    #  How the input data should be interpreted.
-                                                    valueInputOption='USER_ENTERED',
-                                                    # How the input data should be inserted.
-                                                    # insertDataOption='INSERT_ROWS'
-                                                    body=body
-                                                    ).execute()
-        print(result)
-        print('done')
+    logging.debug('Updating..')
+    replayer.record(RANGE_NAME, 1, on_ack=update_acked, on_fail=write_failed)
+    MARKS.labels(1).inc()
+    record_locally(RANGE_NAME, True)
+    update_status_led()
 
 
 def correct(service):
     logging.debug('Correcting..')
-    values = [[0]]
-    body = {'values': values}
-    result = service.spreadsheets().values().update(spreadsheetId=SPREADSHEET_ID,
-                                                    range=RANGE_NAME,
-                                                    #  How the input data should be interpreted.
-                                                    valueInputOption='USER_ENTERED',
-                                                    # How the input data should be inserted.
-                                                    # insertDataOption='INSERT_ROWS'
-                                                    body=body
-                                                    ).execute()
+    replayer.record(RANGE_NAME, 0, on_ack=correction_acked, on_fail=write_failed)
+    MARKS.labels(0).inc()
+    record_locally(RANGE_NAME, False)
+    update_status_led()
 
 
 def read_cell_name(service):
@@ -303,68 +369,186 @@ def read_cell_name(service):
     value = result.get('values', [])
     return value
 
-def read_cell_dates(service):
-    logging.debug('Reading dates..')
-    result = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range='A1:A66').execute()
-    dates = result.get('values', [])
-    return dates
+def refresh_calendar(service):
+    # New rows are picked up incrementally; a missing date may mean the
+    # cached rows were edited, so only then read the whole column
+    with deadline(CALENDAR_TIMEOUT), lane(BACKGROUND):
+        calendar.refresh(service)
+        if calendar.today() is None:
+            calendar.refresh(service, full=True)
 
 
-class EventHandler(pyinotify.ProcessEvent):
-    def process_IN_CLOSE_NOWRITE(self, evt):
-        if evt.pathname == '/sys/logger/gpio44/activate':
-            print('Scroll pressTime was changed!')
-            scroll_button()
-        elif evt.pathname == update_path + 'activate':
-            print('Update pressTime was changed!')
-            update_button()
+def apply_roster():
+    # Swap in the new names and columns, keeping the name on screen
+    global names
+    global column
+    global RANGE_NAME
+    global lcd_call
+    global store
+
+    with roster_lock:
+        names = roster.names
+        column = roster.columns
+        presses.set_names(names, keep=shown_name)
+        if shown_name in names:
+            if lcd_call != 0:
+                RANGE_NAME = column[names.index(shown_name)] + row
+        else:
+            # The student on screen is gone; no marks until the next scroll
+            lcd_call = 0
+        store = AttendanceStore(names, column, store.rows)
+    # The new store is filled from the sheet on the next sync cycle
+    sync.replace_store(store)
+    sync.kick()
+    logging.info('Roster now has %d students', len(names))
+
+
+def refresh_roster(service):
+    # One read of the header row; only a changed header is applied
+    with deadline(ROSTER_TIMEOUT), lane(BACKGROUND):
+        changed = roster.refresh(service)
+    if changed:
+        apply_roster()
+
+
+def schedule_roster_check():
+    timer = threading.Timer(ROSTER_INTERVAL, roster_check)
+    timer.daemon = True
+    timer.start()
+
+
+def roster_check():
+    try:
+        if breaker.is_open():
+            raise ConnectionError('Sheets unreachable')
+        refresh_roster(service)
+    except Exception as e:
+        logging.warning('Roster check failed (%s), keeping %d names', e, len(names))
+    schedule_roster_check()
 
 
-def main():
-    global RANGE_NAME
+def set_lesson_row():
     global row
-    global name_count
-    global old_switch_state
-
-    app_init()
+    global RANGE_NAME
 
-    # lcd_i2c.lcd_string("Hello", lcd_i2c.LCD_LINE_1)
+    lesson = calendar.today()
+    logging.debug('The date is ' + str(datetime.date.today()))
 
-    is_lesson = False
-
-    time = datetime.datetime.now()
-    time_read = time.strftime("%m/%d/%Y").split('/')
-    for i in range(len(time_read)):
-        time_read[i] = time_read[i].lstrip('0')
-    time_str = time_read[0] + '/' +time_read[1] + '/' + time_read[2]
-    logging.debug('The date is ' + time_str)
-    date_list = read_cell_dates(service)
-
-    for i in range(len(date_list)):
-        if date_list[i]:
-            if date_list[i][0] == time_str:
-                row = str(i + 1)
-                print(row)
-                is_lesson = True
-    
-    print(time_str)
-
-    if not is_lesson:
+    if lesson is None:
+        row = ''
         logging.debug('No lesson today..')
         fail_led()
         print('No lesson today.. ')
     else:
+        row = str(lesson.row)
+        sync.add_lessons(term_lesson.row for term_lesson in calendar.term_lessons(lesson.term))
+        if lcd_call != 0:
+            # Keep the name on screen pointing at today's row
+            RANGE_NAME = RANGE_NAME.rstrip('0123456789') + row
         logging.debug('Lesson today - updates active')
+        print(row)
         ack_led()
         print('Time to take roll.. ')
 
-    eventHandler = EventHandler()
-    wm = pyinotify.WatchManager()
-    mask = pyinotify.IN_CLOSE_NOWRITE
-    notifier = pyinotify.Notifier(wm, eventHandler)
-    wdd1 = wm.add_watch(scroll_path + 'activate', mask)
-    wdd2 = wm.add_watch(update_path + 'activate', mask)
-    notifier.loop()
+
+def schedule_rollover():
+    # Re-resolve today's row just after midnight
+    now = datetime.datetime.now()
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(0, 0, 5))
+    timer = threading.Timer((midnight - now).total_seconds(), rollover)
+    timer.daemon = True
+    timer.start()
+
+
+def rollover():
+    logging.debug('Day changed, updating lesson row')
+    try:
+        if breaker.is_open():
+            raise ConnectionError('Sheets unreachable')
+        refresh_calendar(service)
+    except Exception:
+        logging.warning('Calendar refresh failed, using cached dates')
+    set_lesson_row()
+    schedule_rollover()
+
+
+def start_session():
+    # Runs in the background so buttons work while we connect
+    global creds
+    global token_refresher
+    global http_pool
+    global service
+
+    # A cached calendar lets marks be journaled before we are online
+    if calendar.load():
+        set_lesson_row()
+
+    if aggregated:
+        # The aggregator holds the credentials; the breaker follows it
+        service = AggregatorService(batch_writer)
+    else:
+        creds = sheets_client.load_credentials()
+        # One credential for every pooled connection, refreshed ahead of expiry
+        token_refresher = sheets_client.start_token_refresh(creds)
+        # Connections in the pool are kept alive and reused across reconnects
+        http_pool = sheets_client.make_http_pool(creds, scheduler=scheduler)
+        service = sheets_client.build_service(creds, http=http_pool)
+    batch_writer.service = service
+    sync.service = service
+    startup.mark('service')
+
+    while True:
+        try:
+            refresh_calendar(service)
+            break
+        except Exception as e:
+            print('No connection ')
+            logging.warning('No connection')
+            # Retries are paced by the breaker's backoff
+            breaker.record_failure(e)
+            breaker.wait_closed()
+
+    startup.mark('connected')
+    ack_led()
+    logging.debug('Connected ')
+
+    try:
+        refresh_roster(service)
+    except Exception as e:
+        logging.warning('Roster check failed (%s), keeping %d names', e, len(names))
+    schedule_roster_check()
+
+    replayer.kick()
+    set_lesson_row()
+    schedule_rollover()
+    sync.start()
+    sync.kick()
+
+
+def main():
+    app_init()
+    startup.mark('lcd')
+
+    # lcd_i2c.lcd_string("Hello", lcd_i2c.LCD_LINE_1)
+
+    def draw(name_string):
+        if name_string is not None:
+            display.post(name_string)
+
+    runtime = ButtonRuntime({'scroll': scroll_path + 'activate', 'update': update_path + 'activate'},
+                            {'scroll': lambda event: draw(scroll_gesture(event)),
+                             'update': lambda event: draw(update_gesture(event))})
+    # LCD writes run on their own thread; only the latest name is drawn
+    display = runtime.display_worker(show_name)
+
+    session = threading.Thread(target=start_session, name='session')
+    session.daemon = True
+    session.start()
+
+    runtime.start()
+    exporter.start()
+    startup.mark('ready')
+    runtime.run_forever()
 
 
 if __name__ == '__main__':
@@ -376,4 +560,16 @@ if __name__ == '__main__':
         lcd_i2c.lcd_byte(0x01, lcd_i2c.LCD_CMD)
         GPIO.cleanup()
     finally:
+        replayer.stop()
+        sync.stop()
+        batch_writer.close()
+        journal.close()
+        if http_pool is not None:
+            http_pool.close()
+        if token_refresher is not None:
+            token_refresher.stop()
+        if leds is not None:
+            leds.stop()
+        exporter.stop()
+        log_setup.shutdown()
         GPIO.cleanup()
@@ -1,8 +1,11 @@
-import smbus
+try:
+    import smbus
+except ImportError:
+    import smbus2 as smbus
 import time
 
 class LCD:
-    def __init__(self, pi_rev = 2, i2c_addr = 0x3F, backlight = True):
+    def __init__(self, pi_rev = 2, i2c_addr = 0x3F, backlight = True, bus = None, bulk = False):
 
         # device constants
         self.I2C_ADDR  = i2c_addr
@@ -26,9 +29,17 @@ class LCD:
         # Timing constants
         self.E_PULSE = 0.0005
         self.E_DELAY = 0.0005
+        self.E_CLEAR = 0.002
+
+        # bulk = True sends whole strings as block writes of backpack states
+        self.bulk = bulk
+        self.I2C_BLOCK_MAX = 32
 
         # Open I2C interface
-        if pi_rev == 2:
+        if bus is not None:
+            # e.g. a fake_smbus.FakeSMBus for testing without hardware
+            self.bus = bus
+        elif pi_rev == 2:
             # Rev 2 Pi uses 1
             self.bus = smbus.SMBus(1)
         elif pi_rev == 1:
@@ -68,6 +79,40 @@ class LCD:
         self.bus.write_byte(self.I2C_ADDR,(bits & ~self.ENABLE))
         time.sleep(self.E_DELAY)
 
+    def encode_byte(self, bits, mode):
+        # backpack states for one byte: set up, E high, E low per nibble
+        bits_high = mode | (bits & 0xF0) | self.LCD_BACKLIGHT
+        bits_low = mode | ((bits<<4) & 0xF0) | self.LCD_BACKLIGHT
+
+        return [bits_high, bits_high | self.ENABLE, bits_high & ~self.ENABLE,
+                bits_low, bits_low | self.ENABLE, bits_low & ~self.ENABLE]
+
+    def write_states(self, states):
+        # one i2c_rdwr message if available, else 33 byte block writes
+        if hasattr(self.bus, 'i2c_rdwr'):
+            from smbus2 import i2c_msg
+            self.bus.i2c_rdwr(i2c_msg.write(self.I2C_ADDR, states))
+            return
+        for i in range(0, len(states), self.I2C_BLOCK_MAX + 1):
+            chunk = states[i:i + self.I2C_BLOCK_MAX + 1]
+            if len(chunk) == 1:
+                self.bus.write_byte(self.I2C_ADDR, chunk[0])
+            else:
+                self.bus.write_i2c_block_data(self.I2C_ADDR, chunk[0], chunk[1:])
+
+    def lcd_bytes_bulk(self, byte_list):
+        # send a sequence of (bits, mode) pairs as block writes
+        states = []
+        for bits, mode in byte_list:
+            states.extend(self.encode_byte(bits, mode))
+            if mode == self.LCD_CMD and bits in (0x01, 0x02, 0x03):
+                # clear/home must finish before the next byte
+                self.write_states(states)
+                time.sleep(self.E_CLEAR)
+                states = []
+        if states:
+            self.write_states(states)
+
     def message(self, string, line = 1):
         # display message string on LCD line 1 or 2
         if line == 1:
@@ -79,6 +124,13 @@ class LCD:
 
         string = string.ljust(self.LCD_WIDTH," ")
 
+        if self.bulk:
+            byte_list = [(lcd_line, self.LCD_CMD)]
+            for i in range(self.LCD_WIDTH):
+                byte_list.append((ord(string[i]), self.LCD_CHR))
+            self.lcd_bytes_bulk(byte_list)
+            return
+
         self.lcd_byte(lcd_line, self.LCD_CMD)
 
         for i in range(self.LCD_WIDTH):
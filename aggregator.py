@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  aggregator.py
+#  One process that talks to Sheets for many logger devices.
+#
+#  Devices connect over TCP and send one JSON object per line:
+#    {"id": 7, "op": "mark", "spreadsheet": "<id>", "range": "C20", "value": 1}
+#  and get one reply line per request once the write has reached the
+#  sheet (or failed):
+#    {"id": 7, "ok": true}
+#    {"id": 7, "ok": false, "error": "...", "transient": true, "throttled": false, "rejected": false}
+#  "get" and "batchGet" read values for a device (the reply carries the
+#  API's response as "result"); "ping" and "stats" are answered straight
+#  away.
+#
+#  Only spreadsheets on the allow-list (--allow) are served, and when
+#  AGGREGATOR_TOKEN is set every request must carry it as "token".
+#
+#  Marks are batched per spreadsheet by a BatchWriter each, all sharing
+#  one authorized service, its keep-alive pool and one SheetsScheduler
+#  that paces requests to the per-user quota. Each batch window is the
+#  spreadsheet's share of the quota (30 rooms at 60 a minute: 30 s), and
+#  time queued for quota never counts against a write's deadline, so
+#  marks wait and coalesce instead of failing. AggregatorClient is the
+#  device side and stands in for a BatchWriter, and AggregatorService
+#  for the device's Sheets service, so a device needs no token of its own:
+#    AGGREGATOR_ADDR=192.168.7.1:8090 python3 AttendanceLoggerLKM.py
+#
+#  Usage:
+#    python3 aggregator.py --port 8090 --allow <spreadsheet id>
+#    python3 aggregator.py --simulate 30 --marks 40 --sheets-latency 0.2
+# --------------------------------------
+import argparse
+import collections
+import hmac
+import json
+import logging
+import os
+import random
+import socket
+import socketserver
+import threading
+import time
+
+import deadline
+import sheets_client
+from reconnect import Rejected, Throttled, is_rejected, is_throttled, is_transient
+from sheets_batch import BatchWriter
+from sheets_scheduler import BACKGROUND, READ, SheetsScheduler, current_lane, lane
+from token_bucket import USER_QUOTA, TokenBucket
+
+AGGREGATOR_ENV = 'AGGREGATOR_ADDR'
+TOKEN_ENV = 'AGGREGATOR_TOKEN'
+DEFAULT_PORT = 8090
+# Shortest batch window; longer than a device's own, the point is to
+# share batches. With many rooms the window grows to their share of the quota
+AGGREGATOR_WINDOW = 1.0
+CONNECT_TIMEOUT = 3
+# A mark with no reply by then is failed and left to the replayer;
+# covers a quota-sized window (60 rooms at 60 writes a minute), a
+# throttled retry and the batch timeout
+REPLY_TIMEOUT = 120
+# Longest a device read may hold an aggregator thread
+READ_TIMEOUT = 10
+# values.get/batchGet arguments a device may pass through
+READ_PARAMS = ('range', 'ranges', 'majorDimension', 'valueRenderOption', 'dateTimeRenderOption', 'fields')
+# Keep-alive connections to the API shared by all spreadsheets
+POOL_SIZE = 4
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port or DEFAULT_PORT)
+
+
+def make_scheduler(quota=USER_QUOTA):
+    # Every spreadsheet is written as the same user, so one bucket; a
+    # tenth of a minute's quota lets a few rooms' batches through at once
+    return SheetsScheduler(TokenBucket.per_minute(quota, burst=max(1, quota // 10)))
+
+
+def quota_window(spreadsheets, quota=USER_QUOTA, minimum=AGGREGATOR_WINDOW):
+    """Batch window giving each spreadsheet its share of quota writes a minute."""
+    return max(minimum, spreadsheets * 60.0 / quota)
+
+
+def reply_error(reply):
+    # Keep the aggregator's verdict for the device's breaker
+    if reply.get('rejected'):
+        error_type = Rejected
+    elif reply.get('throttled'):
+        error_type = Throttled
+    elif reply.get('transient'):
+        error_type = ConnectionError
+    else:
+        error_type = RuntimeError
+    return error_type(reply.get('error'))
+
+
+class Aggregator:
+    def __init__(self, service, window=AGGREGATOR_WINDOW, allowed=(), token=None, quota=USER_QUOTA):
+        # service must be built on a scheduled pool, see make_scheduler(quota)
+        self.service = service
+        self.window = window
+        self.quota = quota
+        # Spreadsheets devices may reach through our credentials
+        self.allowed = frozenset(allowed)
+        self.token = token
+
+        self._lock = threading.Lock()
+        self._writers = {}
+        self.stats = {'devices': 0, 'marks': 0, 'acked': 0, 'failed': 0}
+
+    def writer(self, spreadsheet_id):
+        with self._lock:
+            writer = self._writers.get(spreadsheet_id)
+            if writer is None:
+                # Marks wait their turn for quota rather than fail
+                writer = BatchWriter(self.service, spreadsheet_id, queue_on_quota=True)
+                self._writers[spreadsheet_id] = writer
+                # Every room's batches share the quota, so widen all windows
+                window = quota_window(len(self._writers), self.quota, self.window)
+                for w in self._writers.values():
+                    w.window = window
+            return writer
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def refuse(self, request):
+        """Why request may not be served, or None if it may."""
+        if self.token and not hmac.compare_digest(str(request.get('token', '')), self.token):
+            return 'Not authorized'
+        # Even a ping, so a device set up for the wrong sheet never looks online
+        if request.get('spreadsheet') not in self.allowed:
+            return 'Spreadsheet not allowed: %s' % request.get('spreadsheet')
+        return None
+
+    def submit(self, spreadsheet_id, cell_range, value, on_ack=None, on_fail=None):
+        self.count('marks')
+
+        def acked(cell_range, response):
+            self.count('acked')
+            if on_ack is not None:
+                on_ack(cell_range, response)
+
+        def failed(cell_range, error):
+            self.count('failed')
+            if on_fail is not None:
+                on_fail(cell_range, error)
+
+        self.writer(spreadsheet_id).submit(cell_range, value, on_ack=acked, on_fail=failed)
+
+    def read(self, op, spreadsheet_id, params, priority=READ, timeout=READ_TIMEOUT):
+        params = dict((k, v) for k, v in params.items() if k in READ_PARAMS)
+        # Device reads never jump ahead of marks
+        if priority not in (READ, BACKGROUND):
+            priority = READ
+        values = self.service.spreadsheets().values()
+        with deadline.deadline(min(timeout, READ_TIMEOUT)), lane(priority):
+            if op == 'get':
+                return values.get(spreadsheetId=spreadsheet_id, **params).execute()
+            return values.batchGet(spreadsheetId=spreadsheet_id, **params).execute()
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['spreadsheets'] = len(self._writers)
+            stats['queued'] = sum(w.pending_count() for w in self._writers.values())
+        return stats
+
+    def close(self):
+        with self._lock:
+            writers = list(self._writers.values())
+        for writer in writers:
+            writer.close()
+
+
+class AggregatorHandler(socketserver.StreamRequestHandler):
+    # Set on the server class by make_server()
+    aggregator = None
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        # Replies come from batch writer threads as well as this one
+        self._write_lock = threading.Lock()
+
+    def reply(self, message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self._write_lock:
+            try:
+                self.wfile.write(data)
+            except OSError:
+                pass
+
+    def handle(self):
+        self.aggregator.count('devices')
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                request_id = request.get('id')
+                op = request.get('op')
+            except (ValueError, AttributeError):
+                self.reply({'id': None, 'ok': False, 'error': 'Bad request', 'transient': False})
+                continue
+            refused = self.aggregator.refuse(request)
+            if refused is not None:
+                self.reply({'id': request_id, 'ok': False, 'error': refused, 'transient': False})
+            elif op == 'mark':
+                self.mark(request_id, request)
+            elif op in ('get', 'batchGet'):
+                self.read(request_id, request)
+            elif op == 'ping':
+                self.reply({'id': request_id, 'ok': True})
+            elif op == 'stats':
+                self.reply({'id': request_id, 'ok': True, 'stats': self.aggregator.snapshot()})
+            else:
+                self.reply({'id': request_id, 'ok': False, 'error': 'Unknown op: %s' % op, 'transient': False})
+
+    def fail(self, request_id, error):
+        self.reply({'id': request_id, 'ok': False, 'error': str(error), 'transient': is_transient(error),
+                    'throttled': is_throttled(error), 'rejected': is_rejected(error)})
+
+    def mark(self, request_id, request):
+        def acked(cell_range, response):
+            self.reply({'id': request_id, 'ok': True})
+
+        def failed(cell_range, error):
+            self.fail(request_id, error)
+
+        try:
+            self.aggregator.submit(request['spreadsheet'], request['range'], request['value'],
+                                   on_ack=acked, on_fail=failed)
+        except KeyError as e:
+            self.reply({'id': request_id, 'ok': False, 'error': 'Missing field %s' % e, 'transient': False})
+
+    def read(self, request_id, request):
+        # Reads are rare (calendar, roster, sync) but slow; keep them off
+        # this thread so the device's marks are not held up behind them
+        def run():
+            try:
+                result = self.aggregator.read(request['op'], request['spreadsheet'], request.get('params') or {},
+                                              request.get('lane', READ), request.get('timeout', READ_TIMEOUT))
+            except Exception as e:
+                self.fail(request_id, e)
+            else:
+                self.reply({'id': request_id, 'ok': True, 'result': result})
+
+        thread = threading.Thread(target=run, name='aggregator-read')
+        thread.daemon = True
+        thread.start()
+
+
+class AggregatorServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(aggregator, host='127.0.0.1', port=DEFAULT_PORT):
+    handler = type('BoundAggregatorHandler', (AggregatorHandler,), {'aggregator': aggregator})
+    return AggregatorServer((host, port), handler)
+
+
+def serve_in_thread(aggregator, host='127.0.0.1', port=0):
+    """Start an aggregator on a background thread; returns (server, address)."""
+    server = make_server(aggregator, host, port)
+    thread = threading.Thread(target=server.serve_forever, name='aggregator')
+    thread.daemon = True
+    thread.start()
+    return server, server.server_address
+
+
+class AggregatorClient:
+    """Device side: submit() like a BatchWriter, writes go to the aggregator.
+
+    submit() only queues the request; a sender thread connects and
+    writes, so a press never waits on the network. Requests with no
+    reply after reply_timeout fail with a TimeoutError.
+    """
+
+    def __init__(self, address, spreadsheet_id, timeout=CONNECT_TIMEOUT, reply_timeout=REPLY_TIMEOUT,
+                 token=None):
+        self.address = address
+        self.spreadsheet_id = spreadsheet_id
+        self.timeout = timeout
+        self.reply_timeout = reply_timeout
+        self.token = token
+        # Same hooks as BatchWriter; service is unused here
+        self.gate = None
+        self.service = None
+
+        self._cond = threading.Condition()
+        self._outbox = collections.deque()
+        self._sock = None
+        self._next_id = 0
+        # id -> (cell_range, on_ack, on_fail, expires)
+        self._callbacks = {}
+        self._running = False
+        self._thread = None
+
+    def _start(self):
+        # Called with _cond held
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='aggregator-sender')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _request(self, message, cell_range, on_ack, on_fail, timeout):
+        with self._cond:
+            closed = self._thread is not None and not self._running
+            if not closed:
+                self._start()
+        if closed:
+            if on_fail is not None:
+                on_fail(cell_range, ConnectionError('Aggregator client closed'))
+            return
+        with self._cond:
+            self._next_id += 1
+            message['id'] = self._next_id
+            message['spreadsheet'] = self.spreadsheet_id
+            if self.token:
+                message['token'] = self.token
+            self._callbacks[message['id']] = (cell_range, on_ack, on_fail, time.monotonic() + timeout)
+            self._outbox.append(message)
+            self._cond.notify()
+
+    def submit(self, cell_range, value, on_ack=None, on_fail=None):
+        if self.gate is not None and not self.gate():
+            if on_fail is not None:
+                on_fail(cell_range, ConnectionError('Aggregator unreachable, mark not sent'))
+            return
+        self._request({'op': 'mark', 'range': cell_range, 'value': value}, cell_range, on_ack, on_fail,
+                      self.reply_timeout)
+
+    def call(self, op, params=None, timeout=None):
+        """Send one request and wait for its reply; raises on failure."""
+        if timeout is None:
+            dl = deadline.current()
+            timeout = self.reply_timeout if dl is None else max(0.0, dl.remaining())
+        done = threading.Event()
+        result = {}
+
+        def answered(_, reply):
+            result['reply'] = reply
+            done.set()
+
+        def failed(_, error):
+            result['error'] = error
+            done.set()
+
+        message = {'op': op, 'lane': current_lane(), 'timeout': timeout}
+        if params:
+            message['params'] = params
+        self._request(message, op, answered, failed, timeout)
+        # The sender thread fails the request once timeout has passed
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+        return result['reply']
+
+    def ping(self, timeout=None):
+        self.call('ping', timeout=timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._running and not self._outbox:
+                    self._cond.wait(self._until_expiry())
+                if not self._running:
+                    return
+                outbox = list(self._outbox)
+                self._outbox.clear()
+                expired = self._take_expired()
+            for cell_range, _, on_fail, _ in expired:
+                if on_fail is not None:
+                    on_fail(cell_range, TimeoutError('No reply from aggregator in %ss' % self.reply_timeout))
+            if outbox:
+                self._send(outbox)
+
+    def _until_expiry(self):
+        if not self._callbacks:
+            return None
+        return max(0.0, min(c[3] for c in self._callbacks.values()) - time.monotonic())
+
+    def _take_expired(self):
+        now = time.monotonic()
+        expired = [request_id for request_id, c in self._callbacks.items() if c[3] <= now]
+        return [self._callbacks.pop(request_id) for request_id in expired]
+
+    def _send(self, messages):
+        # Only the sender thread connects and writes
+        try:
+            sock = self._sock
+            if sock is None:
+                sock = self._connect()
+                with self._cond:
+                    self._sock = sock
+            data = b''.join((json.dumps(m) + '\n').encode('utf-8') for m in messages)
+            sock.sendall(data)
+        except OSError as e:
+            logging.warning('Aggregator unreachable: %s', e)
+            self._disconnect(e)
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = threading.Thread(target=self._read, args=(sock,), name='aggregator-client')
+        reader.daemon = True
+        reader.start()
+        return sock
+
+    def _read(self, sock):
+        try:
+            for line in sock.makefile('rb'):
+                reply = json.loads(line.decode('utf-8'))
+                with self._cond:
+                    callbacks = self._callbacks.pop(reply.get('id'), None)
+                # Late replies to timed out requests are dropped
+                if callbacks is None:
+                    continue
+                cell_range, on_ack, on_fail, _ = callbacks
+                if reply.get('ok'):
+                    if on_ack is not None:
+                        on_ack(cell_range, reply)
+                elif on_fail is not None:
+                    on_fail(cell_range, reply_error(reply))
+        except (OSError, ValueError) as e:
+            logging.warning('Aggregator connection lost: %s', e)
+        self._disconnect(ConnectionError('Aggregator connection closed'), sock)
+
+    def _disconnect(self, error, sock=None):
+        # Fail everything still waiting on this connection
+        with self._cond:
+            if sock is not None and sock is not self._sock:
+                return
+            if self._sock is not None:
+                try:
+                    self._sock.close()
+                except OSError:
+                    pass
+                self._sock = None
+            waiting = list(self._callbacks.values())
+            self._callbacks = {}
+            self._outbox.clear()
+        for cell_range, _, on_fail, _ in waiting:
+            if on_fail is not None:
+                on_fail(cell_range, error)
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._callbacks)
+
+    def flush(self):
+        # Batching happens in the aggregator
+        pass
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._disconnect(ConnectionError('Aggregator client closed'))
+
+
+class _RemoteRequest:
+    def __init__(self, client, op, params):
+        self.client = client
+        self.op = op
+        self.params = params
+
+    def execute(self):
+        return self.client.call(self.op, self.params).get('result', {})
+
+
+class _RemoteValues:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, spreadsheetId=None, **params):
+        return _RemoteRequest(self.client, 'get', params)
+
+    def batchGet(self, spreadsheetId=None, **params):
+        return _RemoteRequest(self.client, 'batchGet', params)
+
+
+class _RemoteSpreadsheets:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, spreadsheetId=None, **params):
+        # Only used as a liveness check; the aggregator answers for Sheets
+        return _RemoteRequest(self.client, 'ping', None)
+
+    def values(self):
+        return _RemoteValues(self.client)
+
+
+class AggregatorService:
+    """Read-only stand-in for a Sheets service, served through client.
+
+    Reads always go to the client's spreadsheet; spreadsheetId is ignored.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def spreadsheets(self):
+        return _RemoteSpreadsheets(self.client)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def simulate(args):
+    """Run the stub, an aggregator and args.simulate devices in one process."""
+    from sheets_stub import StubSheets, serve_in_thread as serve_stub
+
+    sheets = StubSheets(latency=args.sheets_latency, quota=args.sheets_quota)
+    stub, root_url = serve_stub(sheets)
+    os.environ[sheets_client.ROOT_URL_ENV] = root_url
+    http = sheets_client.make_http_pool(None, args.connections, make_scheduler(args.quota))
+    service = sheets_client.build_service(None, http=http)
+    rooms = ['room-%d' % number for number in range(args.simulate)]
+    aggregator = Aggregator(service, window=args.window, allowed=rooms, quota=args.quota)
+    server, address = serve_in_thread(aggregator)
+
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def device(number):
+        rng = random.Random(number)
+        client = AggregatorClient(address, rooms[number])
+        done = threading.Semaphore(0)
+
+        def acked(cell_range, response, sent):
+            with lock:
+                latencies.append(time.monotonic() - sent)
+            done.release()
+
+        def failed(cell_range, error):
+            with lock:
+                failures.append(str(error))
+            done.release()
+
+        for _ in range(args.marks):
+            time.sleep(rng.expovariate(args.rate))
+            sent = time.monotonic()
+            cell = '%s%d' % (rng.choice('CDEFGHI'), rng.randint(20, 32))
+            client.submit(cell, 1, on_ack=lambda c, r, sent=sent: acked(c, r, sent), on_fail=failed)
+        for _ in range(args.marks):
+            done.acquire()
+        client.close()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=device, args=(n,)) for n in range(args.simulate)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.monotonic() - start
+
+    server.shutdown()
+    aggregator.close()
+    stub.shutdown()
+    with sheets.lock:
+        backend = dict(sheets.stats)
+    print('%d devices, %d marks in %.1fs' % (args.simulate, args.simulate * args.marks, wall))
+    print('acked %d, failed %d' % (len(latencies), len(failures)))
+    print('ack latency p50 %.0f ms, p95 %.0f ms' % (percentile(latencies, 0.5) * 1000,
+                                                    percentile(latencies, 0.95) * 1000))
+    print('backend requests: %s' % backend)
+    print('aggregator: %s' % aggregator.snapshot())
+    print('scheduler: %s' % http.scheduler.snapshot())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sheets write aggregator for many logger devices')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--allow', action='append', default=[], metavar='SPREADSHEET',
+                        help='spreadsheet id devices may use; repeat for each room')
+    parser.add_argument('--window', type=float, default=AGGREGATOR_WINDOW, help='shortest batch window in seconds')
+    parser.add_argument('--quota', type=int, default=USER_QUOTA, help='write requests per minute')
+    parser.add_argument('--connections', type=int, default=POOL_SIZE, help='keep-alive connections to the API')
+    parser.add_argument('--simulate', type=int, default=0, help='run this many simulated devices and exit')
+    parser.add_argument('--marks', type=int, default=20, help='marks per simulated device')
+    parser.add_argument('--rate', type=float, default=1.0, help='marks per second per simulated device')
+    parser.add_argument('--sheets-latency', type=float, default=0.1)
+    parser.add_argument('--sheets-quota', type=int, default=0, help='stand-in quota, 0 = unlimited')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.simulate:
+        simulate(args)
+        return
+    if not args.allow:
+        parser.error('--allow is required: devices may only reach the listed spreadsheets')
+
+    creds = sheets_client.load_credentials()
+    token_refresher = sheets_client.start_token_refresh(creds)
+    http = sheets_client.make_http_pool(creds, args.connections, make_scheduler(args.quota))
+    service = sheets_client.build_service(creds, http=http)
+    aggregator = Aggregator(service, window=args.window, allowed=args.allow, token=os.environ.get(TOKEN_ENV),
+                            quota=args.quota)
+    server = make_server(aggregator, args.host, args.port)
+    print('Aggregator on %s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        aggregator.close()
+        if token_refresher is not None:
+            token_refresher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  async_runtime.py
+#  asyncio runtime for the kernel-module button interface.
+#
+#  The sysfs "activate" files are watched with pyinotify's asyncio
+#  notifier. Each press becomes one ButtonEvent in a bounded ring
+#  buffer, and a single task drains the ring in batches and dispatches
+#  the events in order. Handlers must not block: LCD writes go through
+#  a display worker thread and network writes through the batch
+#  writer, so a press is never stuck behind the previous one.
+#
+#  The hold time is sampled from pressTime as the event is ingested,
+#  through a file descriptor kept open per button. Both pressTime
+#  attributes show the kernel module's single time value, so reading it
+#  later (when the handler runs) could pick up the other button's
+#  press; sampling at ingest keeps that window as small as it can be
+#  from user space.
+#
+#  inotify merges a close event into an identical one still unread, so
+#  two presses of one button in quick succession can arrive as a single
+#  event. Nothing the module exposes tells the two apart, so such
+#  presses are not counted here; benchmark.py, which knows how many it
+#  sent, reports them as lost.
+# --------------------------------------
+import asyncio
+import concurrent.futures
+import logging
+import os
+import time
+
+import pyinotify
+
+import metrics
+from deadline import DeadlineExceeded, run_with_deadline
+from event_ring import CAPACITY, ButtonEvent, EventRing
+
+BUTTON_EVENTS = metrics.counter('button_events_total', 'Button presses dispatched', ('button',))
+BUTTON_LOST = metrics.counter('button_events_lost_total', 'Presses lost before dispatch', ('reason',))
+DISPATCH_SECONDS = metrics.histogram('button_dispatch_seconds', 'Press ingest to handler call')
+
+# A full-line LCD write takes a few milliseconds; far longer means the bus is stuck
+DISPLAY_TIMEOUT = 1.0
+
+
+class _EnqueueHandler(pyinotify.ProcessEvent):
+    def my_init(self, runtime=None):
+        self.runtime = runtime
+
+    def process_IN_CLOSE_NOWRITE(self, evt):
+        self.runtime.post(evt.pathname)
+
+    def process_IN_Q_OVERFLOW(self, evt):
+        self.runtime.overflowed()
+
+
+class LatestValueWorker:
+    """Runs func(value) in an executor, only ever for the newest value.
+
+    Values posted while a call is in progress replace each other, so a
+    burst of scroll presses results in one LCD write of the final name
+    rather than a backlog of stale ones.
+    """
+
+    def __init__(self, loop, func, executor, timeout=None):
+        self.loop = loop
+        self.func = func
+        self.executor = executor
+        self.timeout = timeout
+        self._value = None
+        self._ready = asyncio.Event()
+
+    def post(self, value):
+        self._value = value
+        self._ready.set()
+
+    async def run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            value = self._value
+            try:
+                if self.timeout is None:
+                    await self.loop.run_in_executor(self.executor, self.func, value)
+                else:
+                    await run_with_deadline(self.loop, self.executor, self.timeout, self.func, value)
+            except DeadlineExceeded:
+                logging.warning('Worker call took over %.1fs', self.timeout)
+            except Exception:
+                logging.exception('Worker call failed')
+
+
+class ButtonRuntime:
+    def __init__(self, watch_paths, handlers, loop=None, capacity=CAPACITY):
+        # watch_paths: button name -> activate file path
+        # handlers: button name -> non-blocking callable(ButtonEvent)
+        self.loop = loop or asyncio.get_event_loop()
+        self.watch_paths = watch_paths
+        self.handlers = handlers
+        self.events = EventRing(capacity)
+        self._ready = asyncio.Event()
+        self._by_path = dict((path, name) for name, path in watch_paths.items())
+        # button name -> open pressTime fd, opened in start()
+        self._hold_fds = {}
+        # One thread owns the I2C bus so LCD writes never interleave
+        self.lcd_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._notifier = None
+        self._tasks = []
+
+    def post(self, pathname):
+        button = self._by_path.get(pathname)
+        if button is None:
+            return
+        event = ButtonEvent(button, self._sample_hold(button), time.monotonic())
+        if self.events.push(event):
+            self._ready.set()
+        else:
+            BUTTON_LOST.labels('ring_full').inc()
+            logging.warning('Event ring full, dropped %s press', button)
+
+    def overflowed(self):
+        # The kernel's inotify queue overflowed: presses were lost
+        self.events.note_overflow()
+        BUTTON_LOST.labels('inotify_overflow').inc()
+        logging.warning('inotify queue overflow, presses lost')
+
+    def _sample_hold(self, button):
+        fd = self._hold_fds.get(button)
+        if fd is None:
+            return None
+        try:
+            return int(os.pread(fd, 32, 0))
+        except (OSError, ValueError):
+            return None
+
+    def display_worker(self, func):
+        worker = LatestValueWorker(self.loop, func, self.lcd_executor, DISPLAY_TIMEOUT)
+        self.spawn(worker.run())
+        return worker
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.append(task)
+        return task
+
+    async def _dispatch(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            for event in self.events.drain():
+                handler = self.handlers.get(event.button)
+                if handler is None:
+                    continue
+                BUTTON_EVENTS.labels(event.button).inc()
+                DISPATCH_SECONDS.observe(time.monotonic() - event.stamp)
+                try:
+                    handler(event)
+                except Exception:
+                    logging.exception('Handler for %s failed', event.button)
+
+    def start(self):
+        wm = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_NOWRITE
+        self._notifier = pyinotify.AsyncioNotifier(wm, self.loop,
+                                                   default_proc_fun=_EnqueueHandler(runtime=self))
+        for button, path in self.watch_paths.items():
+            hold_path = os.path.join(os.path.dirname(path), 'pressTime')
+            if os.path.exists(hold_path):
+                self._hold_fds[button] = os.open(hold_path, os.O_RDONLY)
+            wm.add_watch(path, mask)
+        self.spawn(self._dispatch())
+
+    def run_forever(self):
+        if self._notifier is None:
+            self.start()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+        for fd in self._hold_fds.values():
+            os.close(fd)
+        self._hold_fds = {}
+        logging.debug('Button events: %s', self.events.stats)
+        self.lcd_executor.shutdown(wait=False)
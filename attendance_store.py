@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  attendance_store.py
+#  Compact in-memory attendance for a whole term.
+#
+#  Attendance is a lesson x student bit matrix in one bytearray: each
+#  lesson (a sheet row) is a run of ceil(students / 8) bytes, one bit
+#  per student (a sheet column). A class of 18 over 40 lessons takes
+#  120 bytes. Running per-student and per-lesson totals are kept next
+#  to the bits, so marking and counting are O(1) and questions like
+#  "who is here today" never need a Sheets call.
+#
+#  The roster (names) and each student's sheet column are stored with
+#  the matrix, so a (student, lesson) pair maps straight to its cell.
+# --------------------------------------
+from array import array
+
+from sheet_range import cell_name, column_index, format_range
+
+
+def cell_value(value):
+    # A sheet cell as a bit: 1 / "1" / TRUE are present, anything else not
+    if isinstance(value, str):
+        value = value.strip()
+        return 1 if value in ('1', 'TRUE', 'true') else 0
+    return 1 if value in (1, True) else 0
+
+
+class Change:
+    def __init__(self, student, lesson, local, remote):
+        self.student = student
+        self.lesson = lesson
+        self.local = local
+        self.remote = remote
+
+
+class AttendanceStore:
+    def __init__(self, names, columns, rows=()):
+        # names[i] sits in sheet column columns[i] ("C", "D", ...)
+        if len(names) != len(columns):
+            raise ValueError('%d names but %d columns' % (len(names), len(columns)))
+        self.names = list(names)
+        self.columns = list(columns)
+        self._col_numbers = [column_index(c) for c in self.columns]
+        self._by_name = dict((name, i) for i, name in enumerate(self.names))
+        self._by_column = dict((c, i) for i, c in enumerate(self._col_numbers))
+        self.stride = (len(self.names) + 7) // 8
+
+        self.rows = []
+        self._by_row = {}
+        self._bits = bytearray()
+        self._student_totals = array('H', [0] * len(self.names))
+        self._lesson_totals = array('H')
+        for row in rows:
+            self.add_lesson(row)
+
+    # Roster and lesson lookups
+
+    def student(self, name):
+        return self._by_name[name]
+
+    def student_for_column(self, col):
+        # col is a letter ("C") or a 1-based number
+        if isinstance(col, str):
+            col = column_index(col)
+        return self._by_column.get(col)
+
+    def add_lesson(self, row):
+        """Return the lesson index for sheet row, adding it if new."""
+        row = int(row)
+        lesson = self._by_row.get(row)
+        if lesson is None:
+            lesson = len(self.rows)
+            self.rows.append(row)
+            self._by_row[row] = lesson
+            self._bits.extend(bytes(self.stride))
+            self._lesson_totals.append(0)
+        return lesson
+
+    def lesson_for_row(self, row):
+        return self._by_row.get(int(row))
+
+    def cell(self, student, lesson):
+        return cell_name(self.rows[lesson], self._col_numbers[student])
+
+    def block_range(self, sheet=None):
+        """A1 range covering every student column and lesson row."""
+        if not self.rows or not self.names:
+            return None
+        return format_range(sheet, min(self.rows), min(self._col_numbers),
+                            max(self.rows), max(self._col_numbers))
+
+    def copy(self):
+        other = AttendanceStore(self.names, self.columns, self.rows)
+        other._bits[:] = self._bits
+        other._student_totals = array('H', self._student_totals)
+        other._lesson_totals = array('H', self._lesson_totals)
+        return other
+
+    # Marks
+
+    def _locate(self, student, lesson):
+        return lesson * self.stride + (student >> 3), 1 << (student & 7)
+
+    def is_marked(self, student, lesson):
+        index, bit = self._locate(student, lesson)
+        return bool(self._bits[index] & bit)
+
+    def set(self, student, lesson, present):
+        """Set one mark; returns True if it changed."""
+        index, bit = self._locate(student, lesson)
+        if bool(self._bits[index] & bit) == bool(present):
+            return False
+        if present:
+            self._bits[index] |= bit
+            self._student_totals[student] += 1
+            self._lesson_totals[lesson] += 1
+        else:
+            self._bits[index] &= ~bit & 0xff
+            self._student_totals[student] -= 1
+            self._lesson_totals[lesson] -= 1
+        return True
+
+    def mark(self, student, lesson):
+        return self.set(student, lesson, True)
+
+    def unmark(self, student, lesson):
+        return self.set(student, lesson, False)
+
+    def student_total(self, student):
+        return self._student_totals[student]
+
+    def lesson_total(self, lesson):
+        return self._lesson_totals[lesson]
+
+    def present(self, lesson):
+        return [name for i, name in enumerate(self.names) if self.is_marked(i, lesson)]
+
+    def nbytes(self):
+        return len(self._bits) + self._student_totals.itemsize * (len(self._student_totals) +
+                                                                  len(self._lesson_totals))
+
+    def changed_cells(self, other):
+        """(student, lesson) pairs whose marks differ from other's.
+
+        Both stores must have the same roster and lessons added in the
+        same order; whole bytes are compared first, so this is cheap when
+        little has changed.
+        """
+        cells = []
+        for index, (a, b) in enumerate(zip(self._bits, other._bits)):
+            changed = a ^ b
+            if not changed:
+                continue
+            lesson, byte = divmod(index, self.stride)
+            for i in range(8):
+                if changed & (1 << i):
+                    cells.append((byte * 8 + i, lesson))
+        return cells
+
+    # Sheet blocks
+
+    def _block_cells(self, values, first_row, first_col, last_row):
+        # Yield (student, lesson, bit) for our cells in a values block.
+        # The API leaves out trailing blank rows and cells, so rows up to
+        # last_row that are missing from values count as all blank
+        if last_row is None:
+            last_row = first_row + len(values) - 1
+        for lesson, row in enumerate(self.rows):
+            if not first_row <= row <= last_row:
+                continue
+            r = row - first_row
+            row_values = values[r] if r < len(values) else []
+            for student, col in enumerate(self._col_numbers):
+                c = col - first_col
+                yield student, lesson, cell_value(row_values[c]) if 0 <= c < len(row_values) else 0
+
+    def load_block(self, values, first_row, first_col, last_row=None):
+        """Replace the marks for the block's rows with the sheet values."""
+        for student, lesson, bit in self._block_cells(values, first_row, first_col, last_row):
+            self.set(student, lesson, bit)
+
+    def diff(self, values, first_row, first_col, last_row=None):
+        """Return a Change for every cell where the block disagrees with us."""
+        changes = []
+        for student, lesson, bit in self._block_cells(values, first_row, first_col, last_row):
+            local = int(self.is_marked(student, lesson))
+            if local != bit:
+                changes.append(Change(student, lesson, local, bit))
+        return changes
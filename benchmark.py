@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  benchmark.py
+#  End-to-end button-press latency benchmark for AttendanceLoggerLKM.
+#
+#  Runs the real app against a simulated /sys/logger tree and GPIO LED
+#  files in a temp directory, a recording fake SMBus for the LCD and
+#  sheets_stub for the Sheets backend. Press sequences are replayed by
+#  writing pressTime and opening/closing the activate files, as the
+#  kernel module does. Each press is numbered and the number written to
+#  a pressSeq file beside pressTime (the real module has no such file),
+#  read back as the app ingests the event, so every measurement is
+#  paired with the press that caused it. Presses inotify merged into a
+#  later one are reported as lost; if an event cannot be paired at all,
+#  the press-paired stages report no percentiles.
+#
+#  Reports p50/p95/p99 latency and throughput per stage:
+#    dispatch    press -> handler called
+#    lcd         LCD write duration
+#    journal     journal append (fsync) duration
+#    sheets      one batch request round trip
+#    led         ack LED pattern duration
+#    scroll_e2e  scroll press -> name on the LCD
+#    update_e2e  update press -> Sheets acknowledged
+#
+#  Usage:
+#    python3 benchmark.py --presses 200 --rate 5 --sheets-latency 0.2 --output bench.json
+#    python3 benchmark.py --replay presses.json --baseline bench.json
+# --------------------------------------
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ('dispatch', 'lcd', 'journal', 'sheets', 'led', 'scroll_e2e', 'update_e2e')
+# Stages timed from a press, only meaningful when every event was paired
+PAIRED_STAGES = ('dispatch', 'scroll_e2e', 'update_e2e')
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class StageTimer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = dict((stage, []) for stage in STAGES)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    def timed(self, stage, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+    def report(self, wall_time, paired=True):
+        # paired=False: presses and events could not be matched, so the
+        # press-timed stages have no trustworthy percentiles
+        out = {}
+        with self.lock:
+            for stage, values in self.samples.items():
+                if not paired and stage in PAIRED_STAGES:
+                    values = []
+                out[stage] = {
+                    'count': len(values),
+                    'p50': percentile(values, 50),
+                    'p95': percentile(values, 95),
+                    'p99': percentile(values, 99),
+                    'max': max(values) if values else None,
+                    'throughput': len(values) / wall_time if wall_time else None,
+                }
+        return out
+
+
+class PressTracker:
+    """Pairs each press sent with the event the app dispatches for it.
+
+    A press whose number is skipped by a later event of the same button
+    was merged by inotify (or dropped from the ring) and is counted as
+    lost. An event whose number is not waiting cannot be paired.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # button -> press number -> perf_counter() when sent, oldest first
+        self.waiting = {'scroll': collections.OrderedDict(), 'update': collections.OrderedDict()}
+        self.counts = {'sent': 0, 'handled': 0, 'lost': 0, 'unpaired': 0}
+        self._numbers = itertools.count(1)
+
+    def send(self, button):
+        with self.lock:
+            seq = next(self._numbers)
+            self.waiting[button][seq] = time.perf_counter()
+            self.counts['sent'] += 1
+        return seq
+
+    def claim(self, button, seq):
+        """Press time of press seq, or None if it was not waiting."""
+        with self.lock:
+            presses = self.waiting[button]
+            if seq not in presses:
+                self.counts['unpaired'] += 1
+                return None
+            while True:
+                number, t_press = presses.popitem(last=False)
+                if number == seq:
+                    self.counts['handled'] += 1
+                    return t_press
+                self.counts['lost'] += 1
+
+    def dropped(self, button, seq):
+        with self.lock:
+            if self.waiting[button].pop(seq, None) is not None:
+                self.counts['lost'] += 1
+
+    def outstanding(self):
+        with self.lock:
+            return sum(len(presses) for presses in self.waiting.values())
+
+    def paired(self):
+        with self.lock:
+            return self.counts['unpaired'] == 0
+
+
+def generate_sequence(presses, rate, roll_length, seed=0):
+    """Scroll roll_length names then mark one, at `rate` presses/second."""
+    rng = random.Random(seed)
+    sequence = []
+    at = 0.0
+    for i in range(presses):
+        if (i + 1) % (roll_length + 1) == 0:
+            # One in ten marks is a long-press correction
+            hold = 1 if rng.random() < 0.1 else 0
+            sequence.append({'at': round(at, 4), 'button': 'update', 'hold': hold})
+        else:
+            sequence.append({'at': round(at, 4), 'button': 'scroll', 'hold': 0})
+        at += rng.expovariate(rate)
+    return sequence
+
+
+def number_text(number):
+    # Fixed width, so rewriting in place never leaves a longer value's tail
+    return '%7d\n' % number
+
+
+def build_sysfs(root):
+    paths = {}
+    for button, gpio in (('scroll', 'gpio44'), ('update', 'gpio68')):
+        path = os.path.join(root, 'sys', 'logger', gpio) + '/'
+        os.makedirs(path)
+        for name, content in (('activate', 'triggered'), ('pressTime', number_text(0)),
+                              ('pressSeq', number_text(0))):
+            with open(path + name, 'w') as f:
+                f.write(content)
+        paths[button] = path
+    for led, gpio in (('red', 'gpio45'), ('green', 'gpio69')):
+        path = os.path.join(root, 'sys', 'class', 'gpio', gpio)
+        os.makedirs(path)
+        with open(os.path.join(path, 'value'), 'w') as f:
+            f.write('0\n')
+        paths[led] = os.path.join(path, 'value')
+    return paths
+
+
+def rewrite(path, number):
+    # Overwritten in place, never truncated, so a pread cannot catch it empty
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, number_text(number).encode('ascii'), 0)
+    finally:
+        os.close(fd)
+
+
+def press(path, hold, seq):
+    # What the kernel module does on release: update pressTime, then
+    # open/close activate, which pyinotify sees as IN_CLOSE_NOWRITE.
+    # pressSeq numbers the press for PressTracker
+    rewrite(path + 'pressSeq', seq)
+    rewrite(path + 'pressTime', hold)
+    with open(path + 'activate', 'r') as f:
+        f.read()
+
+
+def install_fake_gpio():
+    # Adafruit_BBIO is only used for GPIO.cleanup() by the app
+    if 'Adafruit_BBIO' in sys.modules:
+        return
+    gpio = types.ModuleType('Adafruit_BBIO.GPIO')
+    gpio.cleanup = lambda: None
+    package = types.ModuleType('Adafruit_BBIO')
+    package.GPIO = gpio
+    sys.modules['Adafruit_BBIO'] = package
+    sys.modules['Adafruit_BBIO.GPIO'] = gpio
+
+
+def number_events(runtime, paths, tracker):
+    """Tag each event with its press number, read at ingest like pressTime."""
+    fds = dict((button, os.open(paths[button] + 'pressSeq', os.O_RDONLY)) for button in ('scroll', 'update'))
+    push = runtime.events.push
+
+    def numbered_push(event):
+        event.seq = int(os.pread(fds[event.button], 32, 0))
+        if push(event):
+            return True
+        tracker.dropped(event.button, event.seq)
+        return False
+
+    runtime.events.push = numbered_push
+    return fds
+
+
+def instrument(app, timer, tracker, pending):
+    """Wrap the app's stage functions with timers and press tracking."""
+    scroll_gesture = app.scroll_gesture
+    update_gesture = app.update_gesture
+    show_name = app.show_name
+    # Press time of the update being handled, for the mark it records
+    handling = {}
+
+    def timed_scroll_gesture(event):
+        # Every scroll press: step, letter jump, reverse or ignored
+        t_press = tracker.claim('scroll', getattr(event, 'seq', None))
+        if t_press is not None:
+            timer.add('dispatch', time.perf_counter() - t_press)
+        name_string = scroll_gesture(event)
+        if name_string is not None and t_press is not None:
+            pending['scroll_shown'].append(t_press)
+        return name_string
+
+    def timed_show_name(name_string):
+        start = time.perf_counter()
+        show_name(name_string)
+        end = time.perf_counter()
+        timer.add('lcd', end - start)
+        # Coalesced scrolls are all satisfied by the latest draw
+        while pending['scroll_shown']:
+            timer.add('scroll_e2e', end - pending['scroll_shown'].popleft())
+
+    def timed_update_gesture(event):
+        # Every update press, including ones that record nothing
+        t_press = tracker.claim('update', getattr(event, 'seq', None))
+        if t_press is not None:
+            timer.add('dispatch', time.perf_counter() - t_press)
+        handling['update'] = t_press
+        try:
+            return update_gesture(event)
+        finally:
+            del handling['update']
+
+    def recorded(func):
+        # Only presses that journal a mark wait for an ack
+        def wrapper(*args):
+            if handling['update'] is not None:
+                pending['cells'][app.RANGE_NAME].append(handling['update'])
+            return func(*args)
+        return wrapper
+
+    def acked(func):
+        def wrapper(cell_range, response):
+            now = time.perf_counter()
+            presses = pending['cells'][cell_range]
+            while presses:
+                timer.add('update_e2e', now - presses.popleft())
+            return func(cell_range, response)
+        return wrapper
+
+    app.scroll_gesture = timed_scroll_gesture
+    app.update_gesture = timed_update_gesture
+    app.show_name = timed_show_name
+    app.update = recorded(app.update)
+    app.correct = recorded(app.correct)
+    app.update_acked = acked(app.update_acked)
+    app.correction_acked = acked(app.correction_acked)
+    app.ack_led = timer.timed('led', app.ack_led)
+    app.journal.append = timer.timed('journal', app.journal.append)
+    app.batch_writer._execute = timer.timed('sheets', app.batch_writer._execute)
+
+
+def outstanding(tracker, pending):
+    return sum(len(q) for q in pending['cells'].values()) + tracker.outstanding()
+
+
+def run(args, sequence):
+    work_dir = tempfile.mkdtemp(prefix='attendance-bench-')
+    paths = build_sysfs(work_dir)
+    os.chdir(work_dir)
+    sys.path.insert(0, APP_DIR)
+
+    from sheets_stub import StubSheets, serve_in_thread
+    import fake_smbus
+
+    spreadsheet_rows = [['Date'], [datetime.date.today().strftime('%m/%d/%Y')]]
+    sheets = StubSheets(latency=args.sheets_latency, jitter=args.sheets_jitter,
+                        error_rate=args.error_rate, quota=args.quota, seed=args.seed)
+    server, root_url = serve_in_thread(sheets)
+    os.environ['SHEETS_ROOT_URL'] = root_url
+
+    install_fake_gpio()
+    import lcd_i2c
+    lcd_i2c.bus = fake_smbus.FakeSMBus(realtime=True)
+    import AttendanceLoggerLKM as app
+    sheets.load(app.SPREADSHEET_ID, {'Sheet1': spreadsheet_rows})
+
+    app.scroll_path = paths['scroll']
+    app.update_path = paths['update']
+    app.redLEDPath = paths['red']
+    app.greenLEDPath = paths['green']
+    app.batch_writer.window = args.batch_window
+
+    timer = StageTimer()
+    tracker = PressTracker()
+    pending = {'scroll_shown': collections.deque(), 'cells': collections.defaultdict(collections.deque)}
+    instrument(app, timer, tracker, pending)
+
+    runtimes = []
+    button_runtime = app.ButtonRuntime
+
+    seq_fds = {}
+
+    def recording_runtime(*a, **kw):
+        runtime = button_runtime(*a, **kw)
+        seq_fds.update(number_events(runtime, paths, tracker))
+        runtimes.append(runtime)
+        return runtime
+
+    app.ButtonRuntime = recording_runtime
+
+    def run_app():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        app.main()
+
+    app_thread = threading.Thread(target=run_app, name='app')
+    app_thread.daemon = True
+    app_thread.start()
+
+    deadline = time.time() + 30
+    while (app.row == '' or not runtimes) and time.time() < deadline:
+        time.sleep(0.05)
+    if app.row == '':
+        raise RuntimeError('App did not find a lesson row against the stand-in')
+
+    start = time.perf_counter()
+    for event in sequence:
+        delay = start + event['at'] / args.speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        seq = tracker.send(event['button'])
+        press(paths[event['button']], event['hold'], seq)
+
+    deadline = time.time() + args.drain_timeout
+    while outstanding(tracker, pending) and time.time() < deadline:
+        time.sleep(0.05)
+    wall_time = time.perf_counter() - start
+
+    runtime = runtimes[0]
+    runtime.loop.call_soon_threadsafe(runtime.loop.stop)
+    app_thread.join(5)
+    app.replayer.stop()
+    server.shutdown()
+    for fd in seq_fds.values():
+        os.close(fd)
+
+    with sheets.lock:
+        backend = dict(sheets.stats)
+    return {
+        'version': 1,
+        'config': {'presses': len(sequence), 'speed': args.speed, 'batch_window': args.batch_window,
+                   'sheets_latency': args.sheets_latency, 'error_rate': args.error_rate, 'quota': args.quota},
+        'wall_time': wall_time,
+        'throughput': len(sequence) / wall_time if wall_time else None,
+        'unacknowledged': outstanding(tracker, pending),
+        # False if some event could not be paired with its press; the
+        # press-timed stages then carry no percentiles
+        'paired': tracker.paired(),
+        'presses': dict(tracker.counts),
+        'lcd_transactions': len(lcd_i2c.bus.transactions),
+        'backend_requests': backend,
+        'button_events': dict(runtime.events.stats),
+        'stages': timer.report(wall_time, tracker.paired()),
+    }
+
+
+def compare(result, baseline, max_regression):
+    """Print p95 changes against a baseline; return True if any regressed."""
+    regressed = False
+    for stage in STAGES:
+        old = baseline.get('stages', {}).get(stage, {}).get('p95')
+        new = result['stages'][stage]['p95']
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        flag = ''
+        if change > max_regression:
+            regressed = True
+            flag = '  REGRESSION'
+        print('%-11s p95 %8.2f ms -> %8.2f ms (%+.0f%%)%s' % (stage, old * 1000, new * 1000, change * 100, flag),
+              file=sys.stderr)
+    return regressed
+
+
+def print_summary(result):
+    print('%-11s %6s %9s %9s %9s %9s' % ('stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'ops/s'), file=sys.stderr)
+    for stage in STAGES:
+        s = result['stages'][stage]
+        if not s['count']:
+            if stage in PAIRED_STAGES and not result['paired']:
+                print('%-11s %6s   not reported: events could not be paired with presses' % (stage, '-'),
+                      file=sys.stderr)
+            continue
+        print('%-11s %6d %9.2f %9.2f %9.2f %9.1f' % (stage, s['count'], s['p50'] * 1000, s['p95'] * 1000,
+                                                     s['p99'] * 1000, s['throughput']), file=sys.stderr)
+    print('%d presses in %.2fs, %d unacknowledged' % (result['config']['presses'], result['wall_time'],
+                                                      result['unacknowledged']), file=sys.stderr)
+    presses = result['presses']
+    if presses['lost']:
+        print('WARNING: %d of %d presses never reached a handler (merged by inotify or dropped)'
+              % (presses['lost'], presses['sent']), file=sys.stderr)
+    if presses['unpaired']:
+        print('WARNING: %d events could not be paired with a press' % presses['unpaired'], file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Button press to acknowledge latency benchmark')
+    parser.add_argument('--presses', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=4.0, help='mean presses per second')
+    parser.add_argument('--roll-length', type=int, default=3, help='scrolls between marks')
+    parser.add_argument('--replay', help='JSON press sequence: [{"at": s, "button": b, "hold": s}, ...]')
+    parser.add_argument('--save-sequence', help='write the generated press sequence here')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier')
+    parser.add_argument('--batch-window', type=float, default=0.5)
+    parser.add_argument('--sheets-latency', type=float, default=0.1)
+    parser.add_argument('--sheets-jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--quota', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--baseline', help='previous JSON results to compare p95 against')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay, 'r') as f:
+            sequence = json.load(f)
+    else:
+        sequence = generate_sequence(args.presses, args.rate, args.roll_length, args.seed)
+    if args.save_sequence:
+        with open(args.save_sequence, 'w') as f:
+            json.dump(sequence, f, indent=1)
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    # The app prints on every press; keep stdout for the results
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = run(args, sequence)
+
+    print_summary(result)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=1)
+    else:
+        json.dump(result, sys.stdout, indent=1)
+        print()
+
+    if baseline is not None:
+        regressed = compare(result, baseline, args.max_regression)
+        if regressed or not result['paired']:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  bulk_import.py
+#  Streaming import of historical attendance into the sheet.
+#
+#  Reads a CSV or JSONL file of (name, date, present) records and
+#  writes them as chunked values.batchUpdate requests. Records flow
+#  through generators -- read, map to cells, chunk -- so only one chunk
+#  is ever held in memory whatever the size of the file.
+#
+#  Names map to columns through the sheet's header row (Roster) and
+#  dates map to rows through the lesson date column (LessonCalendar).
+#  Records that do not map are counted and skipped, never guessed.
+#
+#  After each chunk is written the line it ended on is saved to a
+#  checkpoint file, so an interrupted import started again with the
+#  same arguments carries on from the first unwritten chunk. Requests
+#  go through the BACKGROUND lane so they never hold up a device.
+#
+#  CSV files need a header with name and date columns and may have a
+#  present column (1/0, yes/no, present/absent; missing means present).
+#  JSONL lines are objects with the same keys.
+#
+#  Usage:
+#    python3 bulk_import.py term2.csv
+#    python3 bulk_import.py export.jsonl --dry-run
+# --------------------------------------
+import argparse
+import collections
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+import sheets_client
+from deadline import deadline
+from lesson_calendar import LessonCalendar, parse_date
+from roster import Roster
+from roster_index import normalise
+from sheet_range import column_index, format_range
+from sheets_scheduler import BACKGROUND, SheetsScheduler, lane
+
+SPREADSHEET_ID = '1NrjRyLdJXOv9Sv5fL32aeQTmobcZ_M9Gj3vp1jX9sgM'
+
+# Cells per batchUpdate, well inside the API's 10 MB request limit;
+# the byte budget keeps long sheet names from pushing a chunk over
+CHUNK_CELLS = 1000
+CHUNK_BYTES = 1024 * 1024
+# Rough JSON size of one {"range": ..., "values": [[...]]} entry
+CELL_OVERHEAD = 32
+CHUNK_TIMEOUT = 30
+PROGRESS_INTERVAL = 5.0
+# Our own header and date caches: the device's roster_cache.json and
+# calendar_cache.json hold its sheet, which an import of another sheet
+# would overwrite
+ROSTER_CACHE = 'import_roster_cache.json'
+CALENDAR_CACHE = 'import_calendar_cache.json'
+
+NAME_FIELDS = ('name', 'student')
+DATE_FIELDS = ('date', 'day', 'lesson date')
+PRESENT_FIELDS = ('present', 'attended', 'value', 'status')
+PRESENT_WORDS = ('1', 'true', 'yes', 'y', 'present', 'p', 'x')
+ABSENT_WORDS = ('0', 'false', 'no', 'n', 'absent', 'a')
+
+
+def checkpoint_path(path):
+    return path + '.checkpoint'
+
+
+def _field(record, fields):
+    for key, value in record.items():
+        if key is not None and key.strip().lower() in fields:
+            return value
+    return None
+
+
+def present_value(value):
+    """1 or 0 for a present field, None if it cannot be read."""
+    if value is None:
+        return 1
+    if isinstance(value, bool) or isinstance(value, (int, float)):
+        return 1 if value else 0
+    text = str(value).strip().lower()
+    if text in PRESENT_WORDS:
+        return 1
+    if text in ABSENT_WORDS:
+        return 0
+    return None
+
+
+def read_records(path, fmt=None):
+    """Yield (line, record dict) from a CSV or JSONL file."""
+    if fmt is None:
+        fmt = 'jsonl' if path.endswith(('.jsonl', '.json', '.ndjson')) else 'csv'
+    with open(path, 'r', newline='') as f:
+        if fmt == 'jsonl':
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield number, record if isinstance(record, dict) else None
+        else:
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+
+
+class CellMapper:
+    """Maps records to (cell range, value), counting what it skips."""
+
+    def __init__(self, calendar, roster, sheet=None):
+        self.calendar = calendar
+        self.sheet = sheet
+        self.columns = dict((normalise(n), column_index(c)) for n, c in zip(roster.names, roster.columns))
+        self.skipped = collections.Counter()
+        # A few examples per reason for the summary
+        self.examples = collections.defaultdict(list)
+
+    def _skip(self, reason, example):
+        self.skipped[reason] += 1
+        if len(self.examples[reason]) < 5 and example not in self.examples[reason]:
+            self.examples[reason].append(example)
+
+    def cell(self, record):
+        if record is None:
+            self._skip('unreadable', '')
+            return None
+        name = _field(record, NAME_FIELDS)
+        col = self.columns.get(normalise(str(name or '')))
+        if col is None:
+            self._skip('unknown name', str(name))
+            return None
+        day = parse_date(_field(record, DATE_FIELDS) or '')
+        lesson = self.calendar.lesson_on(day) if day is not None else None
+        if lesson is None:
+            self._skip('no lesson on date', str(_field(record, DATE_FIELDS)))
+            return None
+        value = present_value(_field(record, PRESENT_FIELDS))
+        if value is None:
+            self._skip('bad present value', str(_field(record, PRESENT_FIELDS)))
+            return None
+        return format_range(self.sheet, lesson.row, col), value
+
+    def cells(self, records):
+        """Yield (line, cell range or None, value) for every record."""
+        for line, record in records:
+            mapped = self.cell(record)
+            if mapped is None:
+                yield line, None, None
+            else:
+                yield line, mapped[0], mapped[1]
+
+
+def chunks(cells, max_cells=CHUNK_CELLS, max_bytes=CHUNK_BYTES):
+    """Group cells into (last line, {range: value}) chunks.
+
+    A range repeated within a chunk keeps its latest value, as it would
+    if the records were written one by one.
+    """
+    chunk = collections.OrderedDict()
+    size = 0
+    last_line = 0
+    for line, cell_range, value in cells:
+        if cell_range is not None and cell_range not in chunk:
+            cost = len(cell_range) + CELL_OVERHEAD
+            if len(chunk) >= max_cells or size + cost > max_bytes:
+                yield last_line, chunk
+                chunk = collections.OrderedDict()
+                size = 0
+            size += cost
+        if cell_range is not None:
+            chunk[cell_range] = value
+        last_line = line
+    yield last_line, chunk
+
+
+class Checkpoint:
+    """The last input line whose chunk is safely in the sheet."""
+
+    def __init__(self, path, source):
+        self.path = path
+        st = os.stat(source)
+        # Resuming into a different file would skip the wrong records
+        self.source = {'path': os.path.abspath(source), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+        self.line = 0
+        self.written = 0
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if saved.get('source') != self.source:
+            logging.warning('Checkpoint %s is for a different input, starting over', self.path)
+            return False
+        self.line = saved.get('line', 0)
+        self.written = saved.get('written', 0)
+        return True
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'source': self.source, 'line': self.line, 'written': self.written}, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class Importer:
+    def __init__(self, service, spreadsheet_id, checkpoint, value_input_option='USER_ENTERED',
+                 timeout=CHUNK_TIMEOUT):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.checkpoint = checkpoint
+        self.value_input_option = value_input_option
+        self.timeout = timeout
+        self.requests = 0
+        # googleapiclient builds a fresh resource (with megabytes of
+        # method docs) per .spreadsheets().values() call; build it once
+        self._values = service.spreadsheets().values()
+
+    def write(self, chunk):
+        data = [{'range': cell_range, 'values': [[value]]} for cell_range, value in chunk.items()]
+        body = {'valueInputOption': self.value_input_option, 'data': data}
+        with deadline(self.timeout), lane(BACKGROUND):
+            self._values.batchUpdate(spreadsheetId=self.spreadsheet_id, body=body).execute()
+        self.requests += 1
+
+    def run(self, cell_chunks, progress=None):
+        """Write every chunk, checkpointing after each one."""
+        for last_line, chunk in cell_chunks:
+            if chunk:
+                self.write(chunk)
+                self.checkpoint.written += len(chunk)
+            if last_line > self.checkpoint.line:
+                self.checkpoint.line = last_line
+                self.checkpoint.save()
+            if progress is not None:
+                progress(self.checkpoint)
+
+
+def pending_records(path, fmt, after_line):
+    for line, record in read_records(path, fmt):
+        if line > after_line:
+            yield line, record
+
+
+class Progress:
+    def __init__(self, mapper, first_line=0, interval=PROGRESS_INTERVAL, out=sys.stderr):
+        self.mapper = mapper
+        self.first_line = first_line
+        self.interval = interval
+        self.out = out
+        self.start = time.monotonic()
+        self.last_report = 0.0
+
+    def __call__(self, checkpoint, final=False):
+        now = time.monotonic()
+        if not final and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        elapsed = max(now - self.start, 1e-6)
+        print('line %d, %d cells written, %d skipped, %.0f lines/s' %
+              (checkpoint.line, checkpoint.written, sum(self.mapper.skipped.values()),
+               (checkpoint.line - self.first_line) / elapsed), file=self.out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream attendance records from CSV or JSONL into the sheet')
+    parser.add_argument('path', help='CSV or JSONL file of name, date, present records')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='default: from the file extension')
+    parser.add_argument('--spreadsheet', default=SPREADSHEET_ID)
+    parser.add_argument('--sheet', help='sheet name, default: the first sheet')
+    parser.add_argument('--chunk', type=int, default=CHUNK_CELLS, help='cells per batchUpdate')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start from the top')
+    parser.add_argument('--dry-run', action='store_true', help='map and count the records without writing')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    creds = sheets_client.load_credentials()
+    token_refresher = sheets_client.start_token_refresh(creds)
+    http = sheets_client.make_http_pool(creds, 1, SheetsScheduler())
+    service = sheets_client.build_service(creds, http=http)
+    try:
+        calendar = LessonCalendar(args.spreadsheet, sheet=args.sheet, cache_path=CALENDAR_CACHE)
+        calendar.load()
+        roster = Roster(args.spreadsheet, sheet=args.sheet, cache_path=ROSTER_CACHE)
+        roster.load()
+        with lane(BACKGROUND):
+            calendar.refresh(service)
+            roster.refresh(service)
+        if not len(roster):
+            print('No student names in the header row', file=sys.stderr)
+            sys.exit(1)
+
+        checkpoint = Checkpoint(checkpoint_path(args.path), args.path)
+        if not args.restart and not args.dry_run and checkpoint.load():
+            print('Resuming after line %d (%d cells already written)' % (checkpoint.line, checkpoint.written),
+                  file=sys.stderr)
+
+        mapper = CellMapper(calendar, roster, sheet=args.sheet)
+        cell_chunks = chunks(mapper.cells(pending_records(args.path, args.format, checkpoint.line)), args.chunk)
+        progress = Progress(mapper, checkpoint.line)
+        if args.dry_run:
+            cells = 0
+            for _, chunk in cell_chunks:
+                cells += len(chunk)
+            print('%d cells would be written' % cells)
+        else:
+            importer = Importer(service, args.spreadsheet, checkpoint)
+            try:
+                importer.run(cell_chunks, progress)
+            except Exception as e:
+                print('Import stopped at line %d: %s; run again to resume' % (checkpoint.line, e), file=sys.stderr)
+                sys.exit(1)
+            progress(checkpoint, final=True)
+            checkpoint.remove()
+            print('%d cells written in %d requests' % (checkpoint.written, importer.requests))
+
+        for reason, count in sorted(mapper.skipped.items()):
+            print('skipped %d (%s), e.g. %s' % (count, reason, ', '.join(mapper.examples[reason])))
+    finally:
+        http.close()
+        if token_refresher is not None:
+            token_refresher.stop()
+
+
+if __name__ == '__main__':
+    main()
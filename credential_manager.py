@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  credential_manager.py
+#  Refreshes the OAuth access token in the background.
+#
+#  oauth2client only refreshes a token once a request has failed with
+#  401, so the first mark after every expiry paid for a token endpoint
+#  round trip and a retry. CredentialManager refreshes the one shared
+#  credential a few minutes before it expires, on its own thread; every
+#  pooled Http is authorized with that same object, so they all pick up
+#  the new token without a request ever waiting for it.
+#
+#  AtomicStorage replaces file.Storage so the token file is written to
+#  a temporary file and renamed into place, and a power cut during a
+#  refresh cannot leave a truncated token behind.
+# --------------------------------------
+import datetime
+import logging
+import os
+import threading
+
+from oauth2client import _helpers, file
+
+import metrics
+
+# Refresh this long before the token expires (seconds)
+REFRESH_MARGIN = 300
+# Retry delays after a failed refresh
+RETRY_DELAY = 15
+MAX_RETRY_DELAY = 120
+# Socket timeout for the token endpoint, so a dead network cannot hang
+# the refresh thread
+REFRESH_TIMEOUT = 10
+
+TOKEN_REFRESHES = metrics.counter('token_refreshes_total', 'Background OAuth token refreshes', ('result',))
+
+
+class AtomicStorage(file.Storage):
+    def locked_put(self, credentials):
+        # Same checks as file.Storage: no symlinked token file, and the
+        # refresh token and client secret readable by the owner only
+        _helpers.validate_file(self._filename)
+        # A fresh name created exclusively: nothing planted at that path
+        # (a symlink or a file with a looser mode) is ever written through
+        tmp_path = '%s.%s.tmp' % (self._filename, os.urandom(8).hex())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(credentials.to_json())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._filename)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+class CredentialManager:
+    def __init__(self, creds, http_factory=None, margin=REFRESH_MARGIN):
+        self.creds = creds
+        # http_factory() returns a plain httplib2.Http for the token endpoint
+        self.http_factory = http_factory
+        self.margin = margin
+
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def expires_in(self):
+        """Seconds until the access token expires, None if unknown."""
+        expiry = getattr(self.creds, 'token_expiry', None)
+        if expiry is None:
+            return None
+        # oauth2client keeps token_expiry as naive UTC
+        return (expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def refresh(self):
+        if self.http_factory is None:
+            from httplib2 import Http
+            http = Http(timeout=REFRESH_TIMEOUT)
+        else:
+            http = self.http_factory()
+        self.creds.refresh(http)
+        logging.debug('Access token refreshed, valid for %.0fs', self.expires_in() or 0)
+
+    def kick(self):
+        self._wake.set()
+
+    def start(self):
+        if self.creds is None:
+            # sheets_stub needs no credentials
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='token-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    def _run(self):
+        retry = RETRY_DELAY
+        while self._running:
+            left = self.expires_in()
+            if left is None or left > self.margin:
+                # Sleep until the margin before expiry, or until kick()
+                self._wake.wait(self.margin if left is None else left - self.margin)
+                self._wake.clear()
+                if not self._running:
+                    break
+            try:
+                self.refresh()
+                TOKEN_REFRESHES.labels('ok').inc()
+                retry = RETRY_DELAY
+            except Exception as e:
+                # The old token may still be good; the 401 path remains
+                # as a fallback if it runs out before we succeed
+                TOKEN_REFRESHES.labels('failed').inc()
+                logging.warning('Token refresh failed (%s), retrying in %ds', e, retry)
+                self._wake.wait(retry)
+                self._wake.clear()
+                retry = min(MAX_RETRY_DELAY, retry * 2)
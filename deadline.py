@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  deadline.py
+#  Thread-safe request deadlines, replacing the SIGALRM based timeout().
+#
+#  signal.alarm only works on the main thread, has one second
+#  resolution and cannot interrupt a worker. Instead a deadline is set
+#  for the current thread (or asyncio task) with
+#
+#    with deadline(0.8):
+#        request.execute()
+#
+#  and PooledHttp turns the time remaining into socket timeouts, so a
+#  slow request fails with DeadlineExceeded (or socket.timeout) in the
+#  thread that made it. Both are TimeoutErrors and reach the caller's
+#  failure path (journal, circuit breaker) instead of being swallowed.
+#
+#  The stack of deadlines lives in a ContextVar, so every thread and
+#  every asyncio task sees only its own: two coroutines interleaving on
+#  the loop thread cannot pop each other's deadline. In a coroutine
+#
+#    with deadline(0.8):
+#        await run_with_deadline(loop, executor, 0.5, blocking_call)
+#
+#  runs the blocking work in an executor under the shorter of the two
+#  deadlines and bounds the await as well.
+# --------------------------------------
+import asyncio
+import contextlib
+import contextvars
+import time
+
+# A tuple, replaced rather than changed, so a copied context (a new
+# task) keeps the deadlines it started with
+_stack = contextvars.ContextVar('deadline_stack', default=())
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded('Deadline of %.3fs exceeded' % self.seconds)
+
+
+def current():
+    """The innermost deadline set in this thread or task, or None."""
+    stack = _stack.get()
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    # A nested deadline can only shorten the one around it
+    outer = current()
+    dl = Deadline(seconds)
+    if outer is not None and outer.expires < dl.expires:
+        dl = outer
+    token = _stack.set(_stack.get() + (dl,))
+    try:
+        yield dl
+    finally:
+        _stack.reset(token)
+
+
+def _call_under_deadline(seconds, func, args):
+    with deadline(seconds):
+        return func(*args)
+
+
+async def run_with_deadline(loop, executor, seconds, func, *args):
+    """Run blocking func(*args) in executor with a deadline; await the result."""
+    # Executor threads do not inherit the task's context; pass it on
+    outer = current()
+    if outer is not None:
+        seconds = max(0.0, min(seconds, outer.remaining()))
+    future = loop.run_in_executor(executor, _call_under_deadline, seconds, func, args)
+    try:
+        # Small grace so the worker's own timeout normally fires first
+        return await asyncio.wait_for(future, seconds + 0.1)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded('Deadline of %.3fs exceeded' % seconds)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  event_ring.py
+#  Bounded ring buffer of button event records.
+#
+#  The inotify callback pushes one record per press and the dispatcher
+#  drains everything that has arrived in one go, so a burst of presses
+#  is handled as a batch in arrival order. Slots are preallocated; when
+#  the ring is full new records are dropped (never the older ones, which
+#  would shift every later press onto the wrong name) and counted.
+# --------------------------------------
+import threading
+
+CAPACITY = 64
+
+
+class ButtonEvent:
+    def __init__(self, button, hold, stamp):
+        self.button = button
+        # Seconds the button was held, None if it could not be read
+        self.hold = hold
+        # time.monotonic() when the press was ingested
+        self.stamp = stamp
+
+
+class EventRing:
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._head = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        # overflows: inotify queue overflows, each losing an unknown number
+        # of presses. inotify also merges a press into an identical unread
+        # one without overflowing; that cannot be seen from here (pressTime
+        # is whole seconds and there is no press count), so received is
+        # the number of events, not of presses
+        self.stats = {'received': 0, 'dropped': 0, 'overflows': 0, 'batches': 0, 'max_batch': 0}
+
+    def __len__(self):
+        return self._size
+
+    def push(self, event):
+        """Append event; returns False (and counts it) if the ring is full."""
+        with self._lock:
+            self.stats['received'] += 1
+            if self._size == self.capacity:
+                self.stats['dropped'] += 1
+                return False
+            self._slots[(self._head + self._size) % self.capacity] = event
+            self._size += 1
+            return True
+
+    def drain(self):
+        """Remove and return every queued event, oldest first."""
+        with self._lock:
+            size = self._size
+            batch = []
+            for i in range(size):
+                index = (self._head + i) % self.capacity
+                batch.append(self._slots[index])
+                self._slots[index] = None
+            self._head = (self._head + size) % self.capacity
+            self._size = 0
+            if size:
+                self.stats['batches'] += 1
+                self.stats['max_batch'] = max(self.stats['max_batch'], size)
+        return batch
+
+    def note_overflow(self):
+        with self._lock:
+            self.stats['overflows'] += 1
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  fake_smbus.py
+#  Recording stand-in for smbus.SMBus, for exercising the LCD code on a
+#  machine with no I2C hardware.
+#
+#  Every byte written to the bus is recorded together with the bus time
+#  it would take at the configured clock, and decode() turns the
+#  recorded PCF8574 backpack states back into the (bits, mode) bytes the
+#  HD44780 would have latched.
+#
+#  Usage:
+#    import lcd_i2c, fake_smbus
+#    lcd_i2c.bus = fake_smbus.FakeSMBus()
+#    lcd_i2c.lcd_string_bulk("Hello", lcd_i2c.LCD_LINE_1)
+#    print(lcd_i2c.bus.decode(), lcd_i2c.bus.bus_time())
+# --------------------------------------
+import time
+
+ENABLE = 0b00000100
+RS = 0b00000001
+
+# 9 clocks per byte (8 data + ack) at 100kHz
+BYTE_TIME = 9 / 100000.0
+
+
+class FakeSMBus:
+    def __init__(self, bus=1, byte_time=BYTE_TIME, rdwr=False, realtime=False):
+        self.byte_time = byte_time
+        # realtime sleeps for the bus time of each transaction, so code
+        # under test sees roughly the latency of a real 100kHz bus
+        self.realtime = realtime
+        # (addr, [states]) per I2C transaction
+        self.transactions = []
+        self.call_time = 0.0
+        if rdwr:
+            # smbus2 style combined transfers
+            self.i2c_rdwr = self._i2c_rdwr
+
+    def _record(self, addr, states):
+        self.transactions.append((addr, list(states)))
+        if self.realtime:
+            time.sleep((1 + len(states)) * self.byte_time)
+
+    def write_byte(self, addr, value):
+        start = time.perf_counter()
+        self._record(addr, [value])
+        self.call_time += time.perf_counter() - start
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        start = time.perf_counter()
+        if len(vals) > 32:
+            raise IOError('block write of %d bytes exceeds SMBus limit' % len(vals))
+        self._record(addr, [cmd] + list(vals))
+        self.call_time += time.perf_counter() - start
+
+    def _i2c_rdwr(self, *msgs):
+        start = time.perf_counter()
+        for msg in msgs:
+            self._record(msg.addr, list(msg))
+        self.call_time += time.perf_counter() - start
+
+    def close(self):
+        pass
+
+    def reset(self):
+        self.transactions = []
+        self.call_time = 0.0
+
+    def states(self):
+        out = []
+        for _, states in self.transactions:
+            out.extend(states)
+        return out
+
+    def bus_time(self):
+        # Address byte plus payload for each transaction
+        total = 0
+        for _, states in self.transactions:
+            total += 1 + len(states)
+        return total * self.byte_time
+
+    def decode(self):
+        """Return the (bits, mode) bytes latched on E falling edges."""
+        out = []
+        prev = 0
+        nibble = None
+        for state in self.states():
+            if prev & ENABLE and not state & ENABLE:
+                if nibble is None:
+                    nibble = prev & 0xF0
+                else:
+                    out.append((nibble | (prev >> 4), prev & RS))
+                    nibble = None
+            prev = state
+        return out
+
+
+def main():
+    import lcd_i2c
+
+    lcd_i2c.bus = FakeSMBus()
+    start = time.perf_counter()
+    lcd_i2c.lcd_string("Nathan H.", lcd_i2c.LCD_LINE_1)
+    legacy = time.perf_counter() - start
+    print('per-byte:  %3d transactions, %.1f ms wall, %.1f ms bus' %
+          (len(lcd_i2c.bus.transactions), legacy * 1000, lcd_i2c.bus.bus_time() * 1000))
+    expected = lcd_i2c.bus.decode()
+
+    lcd_i2c.bus = FakeSMBus()
+    start = time.perf_counter()
+    lcd_i2c.lcd_string_bulk("Nathan H.", lcd_i2c.LCD_LINE_1)
+    bulk = time.perf_counter() - start
+    print('bulk:      %3d transactions, %.1f ms wall, %.1f ms bus' %
+          (len(lcd_i2c.bus.transactions), bulk * 1000, lcd_i2c.bus.bus_time() * 1000))
+    print('waveforms match:', lcd_i2c.bus.decode() == expected)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  gestures.py
+#  Press gestures for taking the roll with two buttons.
+#
+#  Each ButtonEvent is classified from its hold time (the kernel module
+#  reports whole seconds) and its timing against the previous press:
+#
+#    scroll click       next name in the scroll direction
+#    scroll hold 1s     jump to the next initial letter; further clicks
+#                       within MULTI_CLICK_WINDOW keep jumping by letter
+#    scroll hold 2s+    reverse the scroll direction and step once
+#    update click       mark present and advance to the next name
+#    update hold 1s+    correction (absent), staying on the name
+#
+#  Names are browsed in alphabetical order, so a student is a letter
+#  jump and a few clicks away instead of up to a full lap of the
+#  roster, and marking a present student needs one press, not two.
+# --------------------------------------
+import metrics
+
+SCROLL = 'scroll'
+UPDATE = 'update'
+
+# Seconds held; pressTime has whole-second resolution
+LONG_HOLD = 1
+REVERSE_HOLD = 2
+# Seconds between presses for a click to continue a jump burst
+MULTI_CLICK_WINDOW = 0.8
+
+STEP = 'step'
+JUMP = 'jump'
+REVERSE = 'reverse'
+MARK = 'mark'
+CORRECT = 'correct'
+
+GESTURES = metrics.counter('gestures_total', 'Button presses by recognised gesture', ('gesture',))
+
+
+def initial(name):
+    for ch in name:
+        if ch.isalnum():
+            return ch.casefold()
+    return ''
+
+
+class GestureEngine:
+    def __init__(self, names, window=MULTI_CLICK_WINDOW):
+        self.window = window
+        # 1 forwards through the alphabet, -1 backwards
+        self.direction = 1
+        self.stats = dict.fromkeys((STEP, JUMP, REVERSE, MARK, CORRECT), 0)
+        self._last_scroll = None
+        self.set_names(names)
+
+    def set_names(self, names, keep=None):
+        """Use a new roster, staying on keep if it is still there."""
+        self.names = list(names)
+        self.order = sorted(range(len(self.names)), key=lambda i: (self.names[i].casefold(), i))
+        # Position of the student on screen in self.order; -1 before the first
+        self.position = -1
+        if keep in self.names:
+            self.position = self.order.index(self.names.index(keep))
+        # Positions in self.order where a new initial letter starts
+        self._groups = [p for p in range(len(self.order))
+                        if p == 0 or self._initial_at(p) != self._initial_at(p - 1)]
+
+    def _initial_at(self, position):
+        return initial(self.names[self.order[position]])
+
+    def current(self):
+        """Index into names of the student on screen, None before the first."""
+        if self.position < 0 or not self.order:
+            return None
+        return self.order[self.position]
+
+    def classify(self, event):
+        if event.hold is None:
+            return None
+        if event.button == SCROLL:
+            if event.hold >= REVERSE_HOLD:
+                gesture = REVERSE
+            elif event.hold >= LONG_HOLD:
+                gesture = JUMP
+            elif (self._last_scroll is not None and self._last_scroll[1] == JUMP
+                  and event.stamp - self._last_scroll[0] <= self.window):
+                gesture = JUMP
+            else:
+                gesture = STEP
+            self._last_scroll = (event.stamp, gesture)
+        elif event.button == UPDATE:
+            gesture = CORRECT if event.hold >= LONG_HOLD else MARK
+        else:
+            return None
+        self.stats[gesture] += 1
+        GESTURES.labels(gesture).inc()
+        return gesture
+
+    # Moves; each returns the index into names of the new student
+
+    def step(self):
+        count = len(self.order)
+        if not count:
+            return None
+        if self.position < 0:
+            self.position = 0 if self.direction > 0 else count - 1
+        else:
+            self.position = (self.position + self.direction) % count
+        return self.current()
+
+    def jump(self):
+        if not self.order:
+            return None
+        if self.position < 0:
+            return self.step()
+        # Start of the group on screen, then the next start either way
+        group = max(i for i, start in enumerate(self._groups) if start <= self.position)
+        self.position = self._groups[(group + self.direction) % len(self._groups)]
+        return self.current()
+
+    def reverse(self):
+        self.direction = -self.direction
+        return self.step()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  journal.py
+#  Durable write-ahead journal for attendance marks.
+#
+#  Every mark is appended (and fsync'd) to a local line-based journal
+#  before it is handed to the network. A background replayer drains
+#  unapplied marks to the sheet once the connection is back, and the
+#  journal is compacted so applied entries do not pile up on the SD card.
+#
+#  A mark the API refuses by name (a 400 for its range, see
+#  reconnect.Rejected) would fail the same way on every replay, so it is
+#  retired instead: logged, copied to the dead-letter file with the
+#  error, and never resent. Every other failure stays pending.
+#
+#  Record format, one per line, tab separated:
+#    M <seq> <unix time> <range> <value>   - a mark/correction
+#    A <seq>                               - mark <seq> reached the sheet
+#    D <seq>                               - mark <seq> was dead-lettered
+#
+#  Dead-letter file: <seq> <unix time> <range> <value> <error>
+# --------------------------------------
+import logging
+import os
+import threading
+import time
+
+from reconnect import is_rejected
+
+JOURNAL_PATH = 'attendance.journal'
+DEAD_LETTER_PATH = 'attendance.deadletter'
+# Rewrite the journal once this many applied records have accumulated
+COMPACT_THRESHOLD = 200
+# How often the replayer retries pending marks on its own (seconds)
+REPLAY_INTERVAL = 30
+
+
+def parse_value(text):
+    # Marks are written as numbers; keep them numeric when replayed
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+class JournalEntry:
+    def __init__(self, seq, stamp, cell_range, value):
+        self.seq = seq
+        self.stamp = stamp
+        self.cell_range = cell_range
+        self.value = value
+
+
+class Journal:
+    def __init__(self, path=JOURNAL_PATH, dead_letter_path=DEAD_LETTER_PATH):
+        self.path = path
+        self.dead_letter_path = dead_letter_path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._applied = 0
+        self._seq = 0
+        self._load()
+        self._file = open(self.path, 'a')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                # A torn last line from a power cut has no newline; skip it
+                if not line.endswith('\n'):
+                    break
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    if fields[0] == 'M':
+                        entry = JournalEntry(int(fields[1]), float(fields[2]), fields[3], parse_value(fields[4]))
+                        self._entries[entry.seq] = entry
+                        self._seq = max(self._seq, entry.seq)
+                    elif fields[0] in ('A', 'D'):
+                        self._entries.pop(int(fields[1]), None)
+                        self._applied += 1
+                except (IndexError, ValueError):
+                    logging.warning('Skipping bad journal record: %r', line)
+        logging.debug('Journal loaded, %d pending marks', len(self._entries))
+
+    def _write(self, record):
+        self._file.write(record)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, cell_range, value):
+        """Durably record a mark and return its sequence number."""
+        with self._lock:
+            self._seq += 1
+            entry = JournalEntry(self._seq, time.time(), cell_range, value)
+            self._write('M\t%d\t%.3f\t%s\t%s\n' % (entry.seq, entry.stamp, entry.cell_range, entry.value))
+            self._entries[entry.seq] = entry
+            return entry.seq
+
+    def mark_applied(self, seq):
+        """Record that <seq> reached the sheet.
+
+        Older marks for the same cell are superseded by it and are
+        retired as well, so a replay can never overwrite a newer value.
+        """
+        with self._lock:
+            entry = self._entries.get(seq)
+            if entry is None:
+                return
+            done = [s for s, e in self._entries.items() if e.cell_range == entry.cell_range and s <= seq]
+            for s in done:
+                self._write('A\t%d\n' % s)
+                del self._entries[s]
+            self._applied += len(done)
+            if self._applied >= COMPACT_THRESHOLD:
+                self._compact()
+
+    def dead_letter(self, seq, error):
+        """Retire <seq> (and older marks for its cell) after a permanent failure."""
+        with self._lock:
+            entry = self._entries.get(seq)
+            if entry is None:
+                return
+            reason = ' '.join(str(error).split())
+            dead = [s for s, e in self._entries.items() if e.cell_range == entry.cell_range and s <= seq]
+            with open(self.dead_letter_path, 'a') as f:
+                for s in dead:
+                    e = self._entries[s]
+                    f.write('%d\t%.3f\t%s\t%s\t%s\n' % (e.seq, e.stamp, e.cell_range, e.value, reason))
+                f.flush()
+                os.fsync(f.fileno())
+            for s in dead:
+                self._write('D\t%d\n' % s)
+                del self._entries[s]
+            logging.warning('Dead-lettered %d mark(s) for %s: %s', len(dead), entry.cell_range, reason)
+            self._applied += len(dead)
+            if self._applied >= COMPACT_THRESHOLD:
+                self._compact()
+
+    def pending(self):
+        """Unapplied marks, latest per cell, oldest first."""
+        with self._lock:
+            latest = {}
+            for seq in sorted(self._entries):
+                entry = self._entries[seq]
+                latest[entry.cell_range] = entry
+            return sorted(latest.values(), key=lambda e: e.seq)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._entries)
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        # Rewrite only the unapplied marks and atomically swap files
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for seq in sorted(self._entries):
+                e = self._entries[seq]
+                f.write('M\t%d\t%.3f\t%s\t%s\n' % (e.seq, e.stamp, e.cell_range, e.value))
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self._file = open(self.path, 'a')
+        self._applied = 0
+        logging.debug('Journal compacted, %d pending marks', len(self._entries))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class JournalReplayer:
+    def __init__(self, journal, batch_writer, on_fail=None, interval=REPLAY_INTERVAL):
+        self.journal = journal
+        self.batch_writer = batch_writer
+        self.on_fail = on_fail
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+        self._timer = None
+
+    def record(self, cell_range, value, on_ack=None, on_fail=None):
+        """Journal a mark, then queue it for the sheet."""
+        seq = self.journal.append(cell_range, value)
+        self._submit(seq, cell_range, value, on_ack, on_fail)
+        return seq
+
+    def _submit(self, seq, cell_range, value, on_ack=None, on_fail=None):
+        with self._lock:
+            self._in_flight.add(seq)
+
+        def acked(cell_range, response):
+            with self._lock:
+                self._in_flight.discard(seq)
+            self.journal.mark_applied(seq)
+            if on_ack is not None:
+                on_ack(cell_range, response)
+
+        def failed(cell_range, error):
+            with self._lock:
+                self._in_flight.discard(seq)
+            if is_rejected(error):
+                # Resending cannot help; keep it out of every replay
+                self.journal.dead_letter(seq, error)
+            if on_fail is not None:
+                on_fail(cell_range, error)
+
+        self.batch_writer.submit(cell_range, value, on_ack=acked, on_fail=failed)
+
+    def replay(self):
+        # Resend every pending mark that is not already on its way
+        for entry in self.journal.pending():
+            with self._lock:
+                if entry.seq in self._in_flight:
+                    continue
+            logging.debug('Replaying mark %d for %s', entry.seq, entry.cell_range)
+            self._submit(entry.seq, entry.cell_range, entry.value, on_fail=self.on_fail)
+
+    def kick(self):
+        self._wake.set()
+
+    def kick_after(self, delay):
+        # One pending timer at a time, e.g. for a batch of throttled marks
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(delay, self._timer_fired)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timer_fired(self):
+        with self._lock:
+            self._timer = None
+        self.kick()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='journal-replay')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._running and self.journal.pending_count():
+                self.replay()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  lcd_display.py
+#  Shadow-framebuffer display layer for HD44780 LCDs.
+#
+#  Works over either the lcd_i2c module or an LCD.LCD instance; both
+#  expose lcd_byte(bits, mode) and the LCD_* constants. The contents of
+#  every line are remembered, and a write only moves the cursor to and
+#  sends the characters that actually changed.
+# --------------------------------------
+import metrics
+
+LCD_WRITE_SECONDS = metrics.histogram('lcd_write_seconds', 'Time to update one LCD line')
+LCD_BYTES = metrics.counter('lcd_bytes_total', 'Command and character bytes sent to the LCD')
+
+# Moving the cursor costs one command byte, the same as one character,
+# so dirty spans separated by this many unchanged characters or fewer
+# are cheaper to send as one span.
+MERGE_GAP = 1
+
+
+def dirty_spans(old, new, merge_gap=MERGE_GAP):
+    """Return [start, end) spans where new differs from old."""
+    spans = []
+    start = None
+    for i in range(len(new)):
+        if old[i] != new[i]:
+            if start is None:
+                start = i
+            end = i + 1
+        elif start is not None and i - end >= merge_gap:
+            spans.append((start, end))
+            start = None
+    if start is not None:
+        spans.append((start, end))
+    return spans
+
+
+class LCDDisplay:
+    def __init__(self, driver, lines=None, bulk=False):
+        self.driver = driver
+        # bulk sends each write as one block transfer (driver.lcd_bytes_bulk)
+        self.bulk = bulk
+        self.width = driver.LCD_WIDTH
+        if lines is None:
+            lines = [driver.LCD_LINE_1, driver.LCD_LINE_2]
+        # None means the line contents are unknown and must be redrawn
+        self.frame = dict((line, None) for line in lines)
+        self.bytes_sent = 0
+
+    def _send(self, bits, mode):
+        self.driver.lcd_byte(bits, mode)
+        self.bytes_sent += 1
+
+    def reset(self):
+        # Call after the display has been cleared/initialised by the driver
+        for line in self.frame:
+            self.frame[line] = ' ' * self.width
+
+    def invalidate(self):
+        for line in self.frame:
+            self.frame[line] = None
+
+    def clear(self):
+        self._send(0x01, self.driver.LCD_CMD)
+        self.reset()
+
+    def write(self, message, line):
+        with LCD_WRITE_SECONDS.time():
+            return self._write(message, line)
+
+    def _write(self, message, line):
+        # Send only the changed parts of message to the given line address
+        new = message.ljust(self.width, ' ')[:self.width]
+        old = self.frame.get(line)
+        if old is None:
+            spans = [(0, self.width)]
+        else:
+            spans = dirty_spans(old, new)
+
+        byte_list = []
+        for start, end in spans:
+            byte_list.append((line + start, self.driver.LCD_CMD))
+            for i in range(start, end):
+                byte_list.append((ord(new[i]), self.driver.LCD_CHR))
+
+        LCD_BYTES.inc(len(byte_list))
+        if self.bulk:
+            if byte_list:
+                self.driver.lcd_bytes_bulk(byte_list)
+            self.bytes_sent += len(byte_list)
+        else:
+            for bits, mode in byte_list:
+                self._send(bits, mode)
+
+        self.frame[line] = new
+        return len(spans)
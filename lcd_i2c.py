@@ -31,7 +31,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 # --------------------------------------
-import smbus
+try:
+    import smbus
+except ImportError:
+    # smbus2 is a pure Python drop-in and also provides i2c_rdwr
+    import smbus2 as smbus
 import time
 
 # Define some device parameters
@@ -55,10 +59,19 @@ ENABLE = 0b00000100  # Enable bit
 # Timing constants
 E_PULSE = 0.0005
 E_DELAY = 0.0005
+E_CLEAR = 0.002  # Clear/home commands take up to 1.52ms to execute
+
+# Bulk transfers: largest payload of one SMBus block write (plus the
+# leading "command" byte, which the backpack latches like any other)
+I2C_BLOCK_MAX = 32
 
 # Open I2C interface
 # bus = smbus.SMBus(0)  # Rev 1 Pi uses 0
-bus = smbus.SMBus(1)  # Rev 2 Pi uses 1
+try:
+    bus = smbus.SMBus(1)  # Rev 2 Pi uses 1
+except (IOError, OSError):
+    # No I2C adapter (e.g. a dev machine); assign a fake_smbus.FakeSMBus
+    bus = None
 
 
 def lcd_init():
@@ -99,6 +112,57 @@ def lcd_toggle_enable(bits):
     time.sleep(E_DELAY)
 
 
+def lcd_encode_byte(bits, mode):
+    # Backpack output states for one byte: each nibble is set up,
+    # clocked with E high and latched on E falling. At 100kHz every
+    # state is held for ~90us, well over the HD44780 timing minimums,
+    # so no sleeps are needed between them.
+    bits_high = mode | (bits & 0xF0) | LCD_BACKLIGHT
+    bits_low = mode | ((bits << 4) & 0xF0) | LCD_BACKLIGHT
+
+    return [bits_high, bits_high | ENABLE, bits_high & ~ENABLE,
+            bits_low, bits_low | ENABLE, bits_low & ~ENABLE]
+
+
+def lcd_write_states(states):
+    # Send a buffer of backpack states in as few transactions as possible
+    if hasattr(bus, 'i2c_rdwr'):
+        from smbus2 import i2c_msg
+        bus.i2c_rdwr(i2c_msg.write(I2C_ADDR, states))
+        return
+    for i in range(0, len(states), I2C_BLOCK_MAX + 1):
+        chunk = states[i:i + I2C_BLOCK_MAX + 1]
+        if len(chunk) == 1:
+            bus.write_byte(I2C_ADDR, chunk[0])
+        else:
+            bus.write_i2c_block_data(I2C_ADDR, chunk[0], chunk[1:])
+
+
+def lcd_bytes_bulk(byte_list):
+    # Send a sequence of (bits, mode) pairs as block writes
+    states = []
+    for bits, mode in byte_list:
+        states.extend(lcd_encode_byte(bits, mode))
+        if mode == LCD_CMD and bits in (0x01, 0x02, 0x03):
+            # Clear/home need time to finish before the next byte
+            lcd_write_states(states)
+            time.sleep(E_CLEAR)
+            states = []
+    if states:
+        lcd_write_states(states)
+
+
+def lcd_string_bulk(message, line):
+    # Send string to display in one bulk transfer
+
+    message = message.ljust(LCD_WIDTH, " ")
+
+    byte_list = [(line, LCD_CMD)]
+    for i in range(LCD_WIDTH):
+        byte_list.append((ord(message[i]), LCD_CHR))
+    lcd_bytes_bulk(byte_list)
+
+
 """
 def lcd_read(line):
     lcd_byte(line, LCD_CMD)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  led_controller.py
+#  Non-blocking LED pattern engine for the red/green status LEDs.
+#
+#  The GPIO value files are opened once and kept open; a state change
+#  is one lseek + write. Patterns are played by a timer thread, so
+#  play() returns immediately instead of sleeping on the caller's
+#  thread.
+#
+#  A background pattern (offline, syncing, pending-queue-depth) loops
+#  until replaced. One-shot patterns (ack, fail) preempt it and it
+#  resumes when they finish. A one-shot only preempts another one-shot
+#  of lower or equal priority.
+# --------------------------------------
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+# Steps are (red, green, seconds)
+PATTERNS = {
+    'ack': (2, [(0, 1, 0.2), (0, 0, 0.2), (0, 1, 0.2), (0, 0, 0.0)]),
+    'fail': (3, [(1, 0, 1.0), (0, 0, 0.0)]),
+    'offline': (0, [(1, 0, 0.1), (0, 0, 1.9)]),
+    'syncing': (0, [(0, 1, 0.1), (0, 0, 0.4)]),
+}
+LED_PATTERNS = metrics.counter('led_patterns_total', 'LED patterns started', ('pattern',))
+
+# Longest run of blinks shown for the pending queue depth
+MAX_DEPTH_BLINKS = 5
+IDLE = float('inf')
+
+
+def depth_pattern(depth):
+    # One short red blink per pending mark (capped), then a pause
+    steps = []
+    for _ in range(max(1, min(depth, MAX_DEPTH_BLINKS))):
+        steps.extend([(1, 0, 0.15), (0, 0, 0.25)])
+    steps.append((0, 0, 1.5))
+    return (0, steps)
+
+
+class GPIOValue:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY)
+        self.value = None
+
+    def set(self, value):
+        if value == self.value:
+            return
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, b'1\n' if value else b'0\n')
+        self.value = value
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LEDController:
+    def __init__(self, red_path, green_path):
+        self.red = GPIOValue(red_path)
+        self.green = GPIOValue(green_path)
+
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        # (name, priority, steps) of the one-shot and background patterns
+        self._oneshot = None
+        self._background = None
+        self._step = 0
+        self._step_ends = 0.0
+        self._changed = False
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='leds')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(1)
+        self._apply(0, 0)
+        self.red.close()
+        self.green.close()
+
+    def play(self, name):
+        priority, steps = PATTERNS[name]
+        with self._cond:
+            if self._oneshot is not None and self._oneshot[1] > priority:
+                return
+            self._oneshot = (name, priority, steps)
+            self._restart()
+        LED_PATTERNS.labels(name).inc()
+
+    def set_background(self, name, depth=0):
+        # name None turns the background off; 'pending' shows depth
+        if name is None:
+            pattern = None
+        elif name == 'pending':
+            pattern = ('pending:%d' % min(depth, MAX_DEPTH_BLINKS),) + depth_pattern(depth)
+        else:
+            pattern = (name,) + PATTERNS[name]
+        with self._cond:
+            if (pattern and pattern[0]) == (self._background and self._background[0]):
+                return
+            self._background = pattern
+            if self._oneshot is None:
+                self._restart()
+        LED_PATTERNS.labels(name or 'off').inc()
+
+    def background(self):
+        return self._background[0] if self._background else None
+
+    def _restart(self):
+        self._step = 0
+        self._step_ends = 0.0
+        self._changed = True
+        self._cond.notify()
+
+    def _apply(self, red, green):
+        try:
+            self.red.set(red)
+            self.green.set(green)
+        except OSError as e:
+            logging.warning('LED write failed: %s', e)
+
+    def _run(self):
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                if not self._changed and now < self._step_ends:
+                    # None waits until the next play()/set_background()
+                    self._cond.wait(None if self._step_ends == IDLE else self._step_ends - now)
+                    continue
+                self._changed = False
+
+                pattern = self._oneshot or self._background
+                if pattern is None:
+                    self._apply(0, 0)
+                    self._step_ends = IDLE
+                    continue
+
+                steps = pattern[2]
+                if self._step >= len(steps):
+                    if pattern is self._oneshot:
+                        # One-shot done; fall back to the background loop
+                        self._oneshot = None
+                        self._changed = True
+                        self._step = 0
+                        continue
+                    self._step = 0
+                red, green, seconds = steps[self._step]
+                self._apply(red, green)
+                self._step += 1
+                self._step_ends = time.monotonic() + seconds
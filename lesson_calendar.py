@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  lesson_calendar.py
+#  Date -> row index for the lesson date column of the attendance sheet.
+#
+#  The date column is parsed once into real dates and cached on disk
+#  together with a revision fingerprint of the column contents, so a
+#  boot can find today's row without the network. Refreshes only fetch
+#  the rows below the cached ones unless a full reload is needed.
+#
+#  Text cells in the date column (e.g. "Term 2") start a new term; each
+#  dated row after one is numbered as a lesson of that term, matching
+#  the lessons_t2 lesson -> row mapping used by the apps.
+# --------------------------------------
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+CALENDAR_CACHE = 'calendar_cache.json'
+DATE_COLUMN = 'A'
+# Rows fetched per incremental read below the cached rows
+FETCH_CHUNK = 100
+
+# Sheets serial dates count days from 1899-12-30
+SERIAL_EPOCH = datetime.date(1899, 12, 30)
+DATE_FORMATS = ('%m/%d/%Y', '%m/%d/%y', '%Y-%m-%d')
+
+
+def parse_date(value):
+    # Serial numbers come back for date cells when read unformatted
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return SERIAL_EPOCH + datetime.timedelta(days=int(value))
+    text = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    return None
+
+
+def fingerprint(cells):
+    return hashlib.sha1(json.dumps(cells, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Lesson:
+    def __init__(self, day, row, term, number):
+        self.day = day
+        self.row = row
+        self.term = term
+        self.number = number
+
+
+class LessonCalendar:
+    def __init__(self, spreadsheet_id, column=DATE_COLUMN, cache_path=CALENDAR_CACHE, chunk=FETCH_CHUNK,
+                 sheet=None):
+        self.spreadsheet_id = spreadsheet_id
+        self.column = column
+        # Sheet name; None for the first sheet
+        self.sheet = sheet
+        self.cache_path = cache_path
+        self.chunk = chunk
+
+        self.cells = []
+        self.revision = None
+        self._by_date = {}
+        self._terms = {}
+
+    def _index(self):
+        # Rebuild the date and term indexes from the raw column cells
+        self._by_date = {}
+        self._terms = {}
+        term = ''
+        number = 0
+        for i, cell in enumerate(self.cells):
+            if cell in ('', None):
+                continue
+            day = parse_date(cell)
+            if day is None:
+                term = str(cell).strip()
+                number = 0
+                continue
+            number += 1
+            lesson = Lesson(day, i + 1, term, number)
+            self._by_date[day] = lesson
+            self._terms.setdefault(term, []).append(lesson)
+        self.revision = fingerprint(self.cells)
+
+    def load(self):
+        """Load the cached column; returns False if there is no usable cache."""
+        try:
+            with open(self.cache_path, 'r') as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if (cache.get('spreadsheet_id') != self.spreadsheet_id or cache.get('column') != self.column
+                or cache.get('sheet') != self.sheet):
+            return False
+        self.cells = cache.get('cells', [])
+        self._index()
+        if cache.get('revision') != self.revision:
+            logging.warning('Calendar cache is corrupt, ignoring it')
+            self.cells = []
+            self._index()
+            return False
+        return True
+
+    def save(self):
+        cache = {'spreadsheet_id': self.spreadsheet_id, 'sheet': self.sheet, 'column': self.column,
+                 'revision': self.revision, 'cells': self.cells}
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def _fetch(self, service, first_row, last_row=None):
+        cell_range = '%s%d:%s%s' % (self.column, first_row, self.column, last_row or '')
+        if self.sheet:
+            cell_range = "'%s'!%s" % (self.sheet.replace("'", "''"), cell_range)
+        result = service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id,
+                                                     range=cell_range,
+                                                     valueRenderOption='UNFORMATTED_VALUE',
+                                                     dateTimeRenderOption='SERIAL_NUMBER').execute()
+        return [cells[0] if cells else '' for cells in result.get('values', [])]
+
+    def refresh(self, service, full=False):
+        """Bring the index up to date and return True if it changed.
+
+        Without full, only rows below the cached ones are read, in chunks
+        of self.chunk rows, until an empty chunk comes back.
+        """
+        old_revision = self.revision
+        if full or not self.cells:
+            self.cells = self._fetch(service, 1)
+        else:
+            while True:
+                first_row = len(self.cells) + 1
+                new_cells = self._fetch(service, first_row, first_row + self.chunk - 1)
+                if not new_cells:
+                    break
+                self.cells.extend(new_cells)
+                # Keep row numbers aligned if trailing rows were blank
+                if len(new_cells) < self.chunk:
+                    break
+        self._index()
+        if self.revision != old_revision:
+            self.save()
+            logging.debug('Calendar updated, %d lessons', len(self._by_date))
+            return True
+        return False
+
+    def lesson_on(self, day):
+        return self._by_date.get(day)
+
+    def today(self):
+        return self.lesson_on(datetime.date.today())
+
+    def terms(self):
+        return list(self._terms)
+
+    def term_lessons(self, term):
+        return list(self._terms.get(term, []))
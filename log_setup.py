@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  log_setup.py
+#  Bounded, asynchronous logging for the device.
+#
+#  logging calls on the press path only put the record on a bounded
+#  queue (and in an in-memory ring of the last few hundred records); a
+#  listener thread does the formatting and file I/O. Records reach the
+#  SD card in batches: a MemoryHandler holds them until it has a batch,
+#  a WARNING or worse arrives, or the app exits.
+#
+#  app.log rotates by size and is rolled over at every start instead of
+#  being truncated, so app.log.1 ... hold the previous boots. DEBUG
+#  records are kept out of the file by default (ATTENDANCE_LOG_LEVEL
+#  changes that) but stay in the ring, which is written to crash.log on
+#  an uncaught exception, on SIGUSR1, and on SIGTERM before shutdown.
+# --------------------------------------
+import atexit
+import collections
+import logging
+import logging.handlers
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+import metrics
+
+LOG_PATH = 'app.log'
+CRASH_PATH = 'crash.log'
+LEVEL_ENV = 'ATTENDANCE_LOG_LEVEL'
+FILE_LEVEL = 'INFO'
+MAX_BYTES = 256 * 1024
+# Boots (or size rollovers) kept next to the current log
+BACKUPS = 5
+QUEUE_SIZE = 1000
+RING_SIZE = 500
+# Records written to the card together
+FLUSH_BATCH = 50
+
+FORMAT = '%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s'
+
+LOG_DROPPED = metrics.counter('log_records_dropped_total', 'Log records dropped with the queue full')
+
+_state = {}
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records when the queue is full."""
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_DROPPED.inc()
+
+    def prepare(self, record):
+        # Formatting is left to the listener; only make args safe to keep
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RingHandler(logging.Handler):
+    """Keeps the last records in memory for a crash dump."""
+
+    def __init__(self, size=RING_SIZE):
+        logging.Handler.__init__(self)
+        self.records = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, path, reason):
+        formatter = logging.Formatter(FORMAT)
+        with open(path, 'a') as f:
+            f.write('--- %s at %s, last %d records ---\n' % (reason, time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                                            len(self.records)))
+            for record in list(self.records):
+                try:
+                    f.write(formatter.format(record) + '\n')
+                except Exception:
+                    f.write('(unformattable record from %s)\n' % record.name)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def dump_ring(reason):
+    ring = _state.get('ring')
+    if ring is not None:
+        try:
+            ring.dump(_state['crash_path'], reason)
+        except (IOError, OSError):
+            pass
+
+
+def _excepthook(exc_type, exc, tb):
+    logging.critical('Uncaught exception', exc_info=(exc_type, exc, tb))
+    dump_ring('uncaught %s' % exc_type.__name__)
+    _state['excepthook'](exc_type, exc, tb)
+
+
+def _thread_excepthook(args):
+    logging.critical('Uncaught exception in %s', getattr(args.thread, 'name', '?'),
+                     exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
+    dump_ring('uncaught %s in thread' % args.exc_type.__name__)
+
+
+def _on_signal(signum, frame):
+    dump_ring('signal %d' % signum)
+    if signum == signal.SIGTERM:
+        # systemd stop: unwind normally so cleanup code runs
+        raise SystemExit(0)
+
+
+def configure(path=LOG_PATH, crash_path=CRASH_PATH, level=None, max_bytes=MAX_BYTES, backups=BACKUPS,
+              queue_size=QUEUE_SIZE, ring_size=RING_SIZE):
+    """Replace the root logger's handlers with the queued pipeline."""
+    if _state:
+        return
+    level = level or os.environ.get(LEVEL_ENV, FILE_LEVEL)
+
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+    if os.path.getsize(path) > 0:
+        # Keep the previous boot's log instead of truncating it
+        file_handler.doRollover()
+    file_handler.setFormatter(logging.Formatter(FORMAT))
+    file_handler.setLevel(level)
+    batched = logging.handlers.MemoryHandler(FLUSH_BATCH, flushLevel=logging.WARNING, target=file_handler)
+    batched.setLevel(level)
+
+    log_queue = queue.Queue(queue_size)
+    listener = logging.handlers.QueueListener(log_queue, batched, respect_handler_level=True)
+    ring = RingHandler(ring_size)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(logging.DEBUG)
+    # Records the file would not keep never reach the queue at all
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.setLevel(level)
+    root.addHandler(queue_handler)
+    root.addHandler(ring)
+    listener.start()
+
+    _state.update(listener=listener, handlers=(batched, file_handler), ring=ring, crash_path=crash_path,
+                  excepthook=sys.excepthook)
+    sys.excepthook = _excepthook
+    if hasattr(threading, 'excepthook'):
+        threading.excepthook = _thread_excepthook
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, _on_signal)
+        signal.signal(signal.SIGTERM, _on_signal)
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Write out everything still queued or buffered."""
+    listener = _state.get('listener')
+    if listener is None:
+        return
+    _state['listener'] = None
+    listener.stop()
+    for handler in _state['handlers']:
+        handler.flush()
+        handler.close()
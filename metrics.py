@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  metrics.py
+#  Counters, gauges and latency histograms for the hot paths.
+#
+#  Metrics are declared once at module level and updated with a lock
+#  held for a few additions, so recording costs microseconds:
+#
+#    LCD_WRITES = metrics.histogram('lcd_write_seconds', 'LCD line write time')
+#    with LCD_WRITES.time():
+#        ...
+#
+#  Labelled metrics take the label values positionally:
+#    REQUESTS.labels('values.batchUpdate', '200').inc()
+#
+#  An Exporter thread periodically writes every metric to a text file
+#  in the Prometheus exposition format (atomically, for the node
+#  exporter textfile collector) and logs a one-line summary.
+# --------------------------------------
+import bisect
+import contextlib
+import logging
+import os
+import threading
+import time
+
+METRICS_PATH = 'metrics.prom'
+EXPORT_INTERVAL = 60
+# Seconds; spans an in-memory append up to a slow Sheets round trip
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names, values, extra=None):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, label_names, label_values):
+        return ['%s%s %s' % (name, _label_text(label_names, label_values), self.value)]
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+        self.func = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, func):
+        # Read lazily at export time, e.g. a queue's length
+        self.func = func
+
+    def get(self):
+        if self.func is not None:
+            try:
+                return self.func()
+            except Exception:
+                return float('nan')
+        return self.value
+
+    def samples(self, name, label_names, label_values):
+        return ['%s%s %s' % (name, _label_text(label_names, label_values), self.get())]
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q (None if empty)."""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def samples(self, name, label_names, label_values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+            total_sum = self.sum
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket%s %d' % (name, _label_text(label_names, label_values, ('le', le)), cumulative))
+        labels = _label_text(label_names, label_values)
+        lines.append('%s_sum%s %r' % (name, labels, total_sum))
+        lines.append('%s_count%s %d' % (name, labels, total))
+        return lines
+
+
+class Family:
+    """A metric and its labelled children."""
+
+    def __init__(self, name, help_text, kind, factory, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.factory = factory
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._children[()] = factory()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self.factory())
+        return child
+
+    # Unlabelled families behave like their single child
+    def __getattr__(self, attr):
+        if attr.startswith('_') or self.label_names:
+            raise AttributeError(attr)
+        return getattr(self._children[()], attr)
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.samples(self.name, self.label_names, values))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _register(self, name, help_text, kind, factory, label_names):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = Family(name, help_text, kind, factory, label_names)
+            return family
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(name, help_text, 'counter', Counter, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(name, help_text, 'gauge', Gauge, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(name, help_text, 'histogram', lambda: Histogram(buckets), label_names)
+
+    def families(self):
+        with self._lock:
+            return [self._families[name] for name in sorted(self._families)]
+
+    def exposition(self):
+        lines = []
+        for family in self.families():
+            lines.extend(family.exposition())
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path=METRICS_PATH):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.exposition())
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        """One line: totals for counters, count/p50/p95 for histograms."""
+        parts = []
+        for family in self.families():
+            for values, child in sorted(family._children.items()):
+                label = family.name + ('{%s}' % ','.join(values) if values else '')
+                if isinstance(child, Histogram):
+                    if child.count:
+                        parts.append('%s n=%d p50<=%gs p95<=%gs' % (label, child.count, child.quantile(0.5),
+                                                                    child.quantile(0.95)))
+                elif isinstance(child, Counter):
+                    if child.value:
+                        parts.append('%s=%s' % (label, child.value))
+                else:
+                    parts.append('%s=%s' % (label, child.get()))
+        return '; '.join(parts)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+class Exporter:
+    def __init__(self, registry=REGISTRY, path=METRICS_PATH, interval=EXPORT_INTERVAL):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def export(self):
+        try:
+            self.registry.write_textfile(self.path)
+        except (IOError, OSError) as e:
+            logging.warning('Could not write metrics: %s', e)
+        logging.info('Metrics: %s', self.registry.summary())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.export()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.export()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  reconnect.py
+#  Circuit breaker with jittered exponential backoff for the Sheets
+#  connection.
+#
+#  The first transient failure opens the breaker. While it is open no
+#  writes are sent, and a background thread runs a cheap liveness
+#  probe after a backoff delay that doubles on every failed probe. A
+#  successful probe closes the breaker and runs the on_close callback
+#  once, so recovery causes one catch-up batch, not a burst of requests.
+# --------------------------------------
+import logging
+import random
+import threading
+
+import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+BREAKER_TRANSITIONS = metrics.counter('breaker_transitions_total', 'Circuit breaker state changes', ('state',))
+BREAKER_PROBES = metrics.counter('breaker_probes_total', 'Liveness probes while the breaker was open', ('result',))
+
+BASE_DELAY = 1.0
+MAX_DELAY = 300.0
+
+
+class Throttled(Exception):
+    """The request was refused for quota (429), e.g. by the aggregator."""
+
+
+class Rejected(Exception):
+    """The API refused one cell's write itself (a 400 naming its range).
+
+    Only this is worth giving up on: resending fails the same way. Auth
+    errors, 5xx and anything unknown are retried through the breaker.
+    """
+
+
+def is_rejected(error):
+    return isinstance(error, Rejected)
+
+
+def is_throttled(error):
+    # Over quota, not unreachable: wait for the quota, never open the breaker
+    if isinstance(error, Throttled):
+        return True
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return status is not None and int(status) == 429
+
+
+def is_transient(error):
+    """True if error means the API is unreachable or failing."""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is not None:
+        # HttpError: 5xx is worth retrying; 429 is is_throttled(), other 4xx are bugs
+        return int(status) >= 500
+    # Socket errors and timeouts are OSErrors; httplib2 has its own
+    return isinstance(error, OSError) or type(error).__module__.startswith('httplib2')
+
+
+class CircuitBreaker:
+    def __init__(self, probe, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 on_open=None, on_close=None, rng=None):
+        # probe() raises if the API is still unreachable
+        self.probe = probe
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_open = on_open
+        self.on_close = on_close
+        self.random = rng or random.Random()
+
+        self.state = CLOSED
+        self.failures = 0
+        self.probes = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def allow_request(self):
+        return self.state == CLOSED
+
+    def is_open(self):
+        return self.state != CLOSED
+
+    def record_failure(self, error=None):
+        with self._cond:
+            self.failures += 1
+            if self.state != CLOSED:
+                return
+            self.state = OPEN
+            BREAKER_TRANSITIONS.labels(OPEN).inc()
+            logging.warning('Sheets unreachable (%s), circuit open', error)
+            self._thread = threading.Thread(target=self._recover, name='reconnect')
+            self._thread.daemon = True
+            self._thread.start()
+        if self.on_open is not None:
+            self.on_open()
+
+    def wait_closed(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.state == CLOSED, timeout)
+
+    def next_delay(self, delay):
+        # "Equal jitter": at least half the backoff, so retries stay spread
+        # out, with the other half random so devices do not synchronise
+        return delay / 2.0 + self.random.uniform(0, delay / 2.0)
+
+    def _recover(self):
+        delay = self.base_delay
+        while True:
+            wait = self.next_delay(delay)
+            logging.debug('Probing Sheets in %.1fs', wait)
+            with self._cond:
+                self._cond.wait(wait)
+                self.state = HALF_OPEN
+            self.probes += 1
+            try:
+                self.probe()
+            except Exception as e:
+                BREAKER_PROBES.labels('failed').inc()
+                logging.debug('Probe failed: %s', e)
+                with self._cond:
+                    self.state = OPEN
+                delay = min(self.max_delay, delay * 2)
+                continue
+            break
+
+        BREAKER_PROBES.labels('ok').inc()
+        BREAKER_TRANSITIONS.labels(CLOSED).inc()
+        with self._cond:
+            self.state = CLOSED
+            self.failures = 0
+            self._cond.notify_all()
+        logging.debug('Sheets reachable again, circuit closed')
+        if self.on_close is not None:
+            self.on_close()
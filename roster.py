@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  roster.py
+#  Student names and their columns, read from the sheet's header row.
+#
+#  The header row is read in one request (from the first student column
+#  to the end of the row) and every non-empty cell becomes a student
+#  in that column. The cells are cached on disk with a revision
+#  fingerprint, like the lesson calendar, so a boot starts with the
+#  cached roster and never waits for the network to show a name.
+#
+#  The Sheets values API has no ETag or conditional GET, so a
+#  revalidation is the one-row read itself; only a changed fingerprint
+#  rebuilds the roster and rewrites the cache. Until a header has been
+#  read at least once the names and columns passed in are used.
+# --------------------------------------
+import json
+import logging
+import os
+
+from lesson_calendar import fingerprint
+from sheet_range import column_index, column_letter
+
+ROSTER_CACHE = 'roster_cache.json'
+HEADER_ROW = 1
+FIRST_COLUMN = 'C'
+
+
+class Roster:
+    def __init__(self, spreadsheet_id, names=(), columns=(), header_row=HEADER_ROW, first_column=FIRST_COLUMN,
+                 sheet=None, cache_path=ROSTER_CACHE):
+        self.spreadsheet_id = spreadsheet_id
+        self.header_row = header_row
+        self.first_column = first_column
+        self.sheet = sheet
+        self.cache_path = cache_path
+
+        # Header cells from first_column on; None until read or loaded
+        self.cells = None
+        self.names = list(names)
+        self.columns = list(columns)
+        self.revision = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _index(self):
+        names = []
+        columns = []
+        first = column_index(self.first_column)
+        for i, cell in enumerate(self.cells):
+            name = str(cell).strip()
+            if not name:
+                continue
+            if name in names:
+                logging.warning('Roster name %s appears twice, keeping column %s', name,
+                                columns[names.index(name)])
+                continue
+            names.append(name)
+            columns.append(column_letter(first + i))
+        self.names = names
+        self.columns = columns
+        self.revision = fingerprint(self.cells)
+
+    def _key(self):
+        return {'spreadsheet_id': self.spreadsheet_id, 'sheet': self.sheet, 'header_row': self.header_row,
+                'first_column': self.first_column}
+
+    def load(self):
+        """Load the cached header; returns False if there is no usable cache."""
+        try:
+            with open(self.cache_path, 'r') as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if cache.get('key') != self._key():
+            return False
+        cells = cache.get('cells')
+        if not isinstance(cells, list) or cache.get('revision') != fingerprint(cells):
+            logging.warning('Roster cache is corrupt, ignoring it')
+            return False
+        self.cells = cells
+        self._index()
+        return True
+
+    def save(self):
+        cache = {'key': self._key(), 'revision': self.revision, 'cells': self.cells}
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def _fetch(self, service):
+        cell_range = '%d:%d' % (self.header_row, self.header_row)
+        if self.sheet:
+            cell_range = "'%s'!%s" % (self.sheet.replace("'", "''"), cell_range)
+        result = service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id, range=cell_range,
+                                                     fields='values').execute()
+        values = result.get('values', [])
+        row = values[0] if values else []
+        return row[column_index(self.first_column) - 1:]
+
+    def refresh(self, service):
+        """Read the header row and return True if the roster changed."""
+        cells = self._fetch(service)
+        # Trailing empty cells are not returned, but be sure of it
+        while cells and str(cells[-1]).strip() == '':
+            cells.pop()
+        if not any(str(cell).strip() for cell in cells):
+            # Never swap a working roster for an empty one
+            logging.warning('Roster header row is empty, keeping %d names', len(self.names))
+            return False
+        if self.cells is not None and fingerprint(cells) == self.revision:
+            return False
+        old = (self.names, self.columns)
+        self.cells = cells
+        self._index()
+        self.save()
+        if (self.names, self.columns) == old:
+            return False
+        logging.info('Roster updated, %d students', len(self.names))
+        return True
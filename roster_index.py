@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  roster_index.py
+#  Prefix and fuzzy lookup of student names.
+#
+#  Every name is indexed under its full form and under each of its
+#  words, case-folded, in one sorted list. A query resolves by exact
+#  match, then by prefix (a bisect into the sorted keys), then by edit
+#  similarity (difflib), so "nat z", "Haniell" and "jer" all find
+#  their student without scanning the roster per keystroke.
+# --------------------------------------
+import bisect
+import difflib
+
+# difflib ratio below which a name is not suggested
+FUZZY_CUTOFF = 0.6
+MAX_SUGGESTIONS = 3
+
+
+def normalise(text):
+    return ' '.join(text.replace('.', ' ').split()).casefold()
+
+
+class RosterIndex:
+    def __init__(self, names):
+        self.names = list(names)
+        # key -> names indexed under it, in roster order
+        self._by_key = {}
+        # full normalised name -> names, so "Leo" is found beside "Leo Fang"
+        self._by_name = {}
+        for name in self.names:
+            key = normalise(name)
+            self._by_name.setdefault(key, []).append(name)
+            for k in [key] + key.split():
+                entries = self._by_key.setdefault(k, [])
+                if name not in entries:
+                    entries.append(name)
+        self._keys = sorted(self._by_key)
+
+    def _collect(self, keys):
+        found = []
+        for key in keys:
+            for name in self._by_key[key]:
+                if name not in found:
+                    found.append(name)
+        return found
+
+    def prefix(self, query):
+        words = normalise(query).split()
+        if not words:
+            return []
+        start = bisect.bisect_left(self._keys, words[0])
+        end = bisect.bisect_left(self._keys, words[0] + '\uffff')
+        found = self._collect(self._keys[start:end])
+        if len(words) > 1:
+            # "nat z" narrows "nat" to names that also have a word "z..."
+            found = [n for n in found
+                     if all(any(w.startswith(q) for w in normalise(n).split()) for q in words[1:])]
+        return found
+
+    def fuzzy(self, query, n=MAX_SUGGESTIONS):
+        matches = difflib.get_close_matches(normalise(query), self._keys, n, FUZZY_CUTOFF)
+        return self._collect(matches)[:n]
+
+    def lookup(self, query):
+        """Candidate names for query, best first."""
+        key = normalise(query)
+        if len(self._by_name.get(key, ())) == 1:
+            return list(self._by_name[key])
+        if key in self._by_key and len(self._by_key[key]) == 1:
+            return list(self._by_key[key])
+        return self.prefix(query) or self.fuzzy(query)
+
+    def resolve(self, query):
+        """Return (name, candidates); name is None unless exactly one matches."""
+        candidates = self.lookup(query)
+        if len(candidates) == 1:
+            return candidates[0], candidates
+        return None, candidates
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  sheet_range.py
+#  Helpers for A1 notation ("C5", "A1:A66", "Sheet1!C2:V40").
+#
+#  Rows and columns are 1-based, as in the sheet. Open-ended ranges
+#  such as "A1:A" have None for the missing bound.
+# --------------------------------------
+import re
+
+_CELL = re.compile(r'^([A-Za-z]*)(\d*)$')
+
+
+def column_index(letters):
+    # "A" -> 1, "Z" -> 26, "AA" -> 27
+    index = 0
+    for ch in letters.upper():
+        index = index * 26 + (ord(ch) - ord('A') + 1)
+    return index
+
+
+def column_letter(index):
+    letters = ''
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+
+def cell_name(row, col):
+    return column_letter(col) + str(row)
+
+
+def parse_cell(text):
+    """Return (row, col) for a cell reference; missing parts are None."""
+    match = _CELL.match(text.strip())
+    if match is None:
+        raise ValueError('Bad cell reference: ' + text)
+    letters, digits = match.groups()
+    col = column_index(letters) if letters else None
+    row = int(digits) if digits else None
+    return row, col
+
+
+def split_sheet(a1):
+    # "'My sheet'!A1:B2" -> ("My sheet", "A1:B2")
+    if '!' not in a1:
+        return None, a1
+    sheet, cells = a1.rsplit('!', 1)
+    if sheet.startswith("'") and sheet.endswith("'"):
+        sheet = sheet[1:-1].replace("''", "'")
+    return sheet, cells
+
+
+def parse_range(a1):
+    """Return (sheet, first_row, first_col, last_row, last_col)."""
+    sheet, cells = split_sheet(a1)
+    if ':' in cells:
+        start, end = cells.split(':', 1)
+    else:
+        start = end = cells
+    first_row, first_col = parse_cell(start)
+    last_row, last_col = parse_cell(end)
+    return sheet, first_row or 1, first_col or 1, last_row, last_col
+
+
+def format_range(sheet, first_row, first_col, last_row=None, last_col=None):
+    # Leave both last bounds out for a single cell
+    start = cell_name(first_row, first_col)
+    if last_row is None and last_col is None:
+        cells = start
+    else:
+        end = column_letter(last_col or first_col) + (str(last_row) if last_row else '')
+        cells = start if end == start else start + ':' + end
+    if sheet:
+        return "'%s'!%s" % (sheet.replace("'", "''"), cells)
+    return cells
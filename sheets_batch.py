@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  sheets_batch.py
+#  Coalescing batch writer for Google Sheets cell updates.
+#
+#  Marks are queued with submit() and sent together as a single
+#  spreadsheets().values().batchUpdate once the batching window has
+#  elapsed (or the batch is full). Each submitted cell gets its own
+#  ack/fail callback so the caller can still drive the LEDs per mark.
+#
+#  A batch refused with a 400 that names one of its ranges is split and
+#  the halves resent, so only the bad cell fails, with Rejected. Any
+#  other error (auth, 5xx, a 400 about the request as a whole) fails
+#  every cell as it is, to be retried; it is never split.
+#
+#  One batch is in flight at a time; marks submitted meanwhile gather
+#  for the next one. With queue_on_quota the timeout only starts once
+#  the scheduler lets the request go, and a throttled batch goes back
+#  into the queue (coalescing with newer writes) instead of failing.
+# --------------------------------------
+import logging
+import threading
+import time
+
+from deadline import deadline
+from reconnect import Rejected, is_throttled
+from sheets_scheduler import DEFAULT_RETRY_AFTER, MARK, lane, send_deadline
+
+# Default time to wait for more marks before sending a batch (seconds)
+BATCH_WINDOW = 0.5
+# Maximum number of cells in a single batchUpdate request
+BATCH_MAX = 100
+# Time allowed for one batchUpdate before its cells are failed (seconds)
+BATCH_TIMEOUT = 5.0
+
+
+def names_a_range(error, batch):
+    # A 400 such as "Unable to parse range: Sheet1!C0" blames one cell
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is None or int(status) != 400:
+        return False
+    text = str(error)
+    return any(cell.cell_range in text for cell in batch)
+
+
+class PendingCell:
+    def __init__(self, cell_range, value, on_ack=None, on_fail=None):
+        self.cell_range = cell_range
+        self.value = value
+        self.callbacks = []
+        self.add_callbacks(on_ack, on_fail)
+
+    def add_callbacks(self, on_ack, on_fail):
+        self.callbacks.append((on_ack, on_fail))
+
+    def ack(self, response):
+        for on_ack, _ in self.callbacks:
+            if on_ack is not None:
+                on_ack(self.cell_range, response)
+
+    def fail(self, error):
+        for _, on_fail in self.callbacks:
+            if on_fail is not None:
+                on_fail(self.cell_range, error)
+
+
+class BatchWriter:
+    def __init__(self, service, spreadsheet_id, window=BATCH_WINDOW, max_batch=BATCH_MAX,
+                 value_input_option='USER_ENTERED', timeout=BATCH_TIMEOUT, queue_on_quota=False):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.value_input_option = value_input_option
+        self.queue_on_quota = queue_on_quota
+        # Optional gate() -> bool; batches are failed without a request
+        # while it returns False (e.g. the circuit breaker is open)
+        self.gate = None
+
+        self._lock = threading.Lock()
+        # Flushes are serialised so batches reach the sheet in submit order
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._by_range = {}
+        self._timer = None
+        # When the oldest queued cell arrived; the window runs from there
+        self._first_at = None
+        self._sending = False
+        # No batch before this (monotonic) time, after a throttled one
+        self._hold_until = 0.0
+
+    def submit(self, cell_range, value, on_ack=None, on_fail=None):
+        """Queue a single cell write, coalescing repeated writes to one cell.
+
+        The latest value for a range wins; callbacks of superseded writes
+        are kept and fire with the outcome of the write that replaced them.
+        """
+        with self._lock:
+            cell = self._by_range.get(cell_range)
+            if cell is not None:
+                cell.value = value
+                cell.add_callbacks(on_ack, on_fail)
+            else:
+                cell = PendingCell(cell_range, value, on_ack, on_fail)
+                if not self._pending:
+                    self._first_at = time.monotonic()
+                self._pending.append(cell)
+                self._by_range[cell_range] = cell
+            # While a batch is on its way the next is armed when it is done
+            full = not self._sending and len(self._pending) >= self.max_batch
+            if not full and not self._sending and self._timer is None:
+                self._arm()
+        if full:
+            self.flush()
+
+    def _arm(self):
+        # Called with _lock held
+        now = time.monotonic()
+        if len(self._pending) >= self.max_batch:
+            delay = 0.0
+        else:
+            delay = self._first_at + self.window - now
+        delay = max(0.0, delay, self._hold_until - now)
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        # Send everything queued so far as one batchUpdate
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                batch = self._pending
+                self._pending = []
+                self._by_range = {}
+                self._sending = bool(batch)
+            if not batch:
+                return
+            try:
+                self._send(batch)
+            finally:
+                with self._lock:
+                    self._sending = False
+                    if self._pending and self._timer is None:
+                        self._arm()
+
+    def close(self):
+        self.flush()
+
+    def _execute(self, body):
+        # A timeout raises like any other failure, so the cells are failed
+        timed = send_deadline if self.queue_on_quota else deadline
+        with timed(self.timeout), lane(MARK):
+            return self.service.spreadsheets().values().batchUpdate(spreadsheetId=self.spreadsheet_id,
+                                                                    body=body).execute()
+
+    def _requeue(self, batch, delay):
+        # Throttled cells go back in front of anything queued since; a
+        # newer write to the same cell carries the older one's callbacks
+        with self._lock:
+            cells = []
+            for cell in batch:
+                newer = self._by_range.get(cell.cell_range)
+                if newer is not None:
+                    newer.callbacks[:0] = cell.callbacks
+                else:
+                    cells.append(cell)
+                    self._by_range[cell.cell_range] = cell
+            self._pending = cells + self._pending
+            self._first_at = time.monotonic() - self.window
+            self._hold_until = time.monotonic() + delay
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _send(self, batch):
+        data = [{'range': cell.cell_range, 'values': [[cell.value]]} for cell in batch]
+        body = {'valueInputOption': self.value_input_option, 'data': data}
+        logging.debug('Sending batch of %d cells', len(batch))
+        try:
+            if self.gate is not None and not self.gate():
+                raise ConnectionError('Sheets unreachable, batch not sent')
+            result = self._execute(body)
+        except Exception as e:
+            if self.queue_on_quota and is_throttled(e):
+                logging.warning('Batch throttled, %d cells queued again', len(batch))
+                self._requeue(batch, max(self.window, DEFAULT_RETRY_AFTER))
+                return
+            logging.warning('Batch update failed: %s', e)
+            if names_a_range(e, batch):
+                if len(batch) > 1:
+                    half = len(batch) // 2
+                    self._send(batch[:half])
+                    self._send(batch[half:])
+                else:
+                    batch[0].fail(Rejected(str(e)))
+                return
+            for cell in batch:
+                cell.fail(e)
+            return
+
+        # Responses come back in the same order as the request data
+        responses = result.get('responses', [])
+        for i, cell in enumerate(batch):
+            if i < len(responses) and responses[i].get('updatedCells', 1):
+                cell.ack(responses[i])
+            else:
+                cell.fail(RuntimeError('No update reported for ' + cell.cell_range))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  sheets_client.py
+#  Fast-boot construction of the Google Sheets service.
+#
+#  The Google client libraries are only imported when a service is
+#  first built, and the Sheets discovery document is kept in a local,
+#  versioned cache so build() does not need a network round trip at
+#  boot. StartupTimer records how long the device takes to come up.
+# --------------------------------------
+import json
+import logging
+import os
+import threading
+import time
+
+from sheets_transport import POOL_SIZE, PooledHttp
+
+# If modifying these scopes, delete the file token.json.
+SCOPES = 'https://www.googleapis.com/auth/spreadsheets'
+
+TOKEN_PATH = 'tokenPython.json'
+CREDENTIALS_PATH = 'credentials.json'
+
+API_NAME = 'sheets'
+API_VERSION = 'v4'
+DISCOVERY_CACHE_DIR = 'discovery_cache'
+
+STARTUP_LOG = 'startup.log'
+
+# Set to e.g. http://127.0.0.1:8089/ to talk to sheets_stub.py instead
+# of Google; no credentials are used then.
+ROOT_URL_ENV = 'SHEETS_ROOT_URL'
+
+
+def stub_root_url():
+    return os.environ.get(ROOT_URL_ENV)
+
+
+def load_credentials(token_path=TOKEN_PATH, credentials_path=CREDENTIALS_PATH, scopes=SCOPES):
+    if stub_root_url():
+        return None
+
+    from oauth2client import client, tools
+    from credential_manager import AtomicStorage
+
+    # Refreshed tokens are written back atomically through this store
+    store = AtomicStorage(token_path)
+    creds = store.get()
+    if not creds or creds.invalid:
+        flow = client.flow_from_clientsecrets(credentials_path, scopes)
+        creds = tools.run_flow(flow, store)
+    return creds
+
+
+def start_token_refresh(creds):
+    """Keep creds' access token fresh from a background thread.
+
+    Returns the started CredentialManager, or None when there is nothing
+    to refresh (sheets_stub).
+    """
+    if creds is None:
+        return None
+    from credential_manager import CredentialManager
+
+    manager = CredentialManager(creds)
+    manager.start()
+    return manager
+
+
+def discovery_cache_path(api=API_NAME, version=API_VERSION, cache_dir=DISCOVERY_CACHE_DIR):
+    return os.path.join(cache_dir, '%s.%s.json' % (api, version))
+
+
+def load_discovery_document(api=API_NAME, version=API_VERSION, cache_dir=DISCOVERY_CACHE_DIR):
+    path = discovery_cache_path(api, version, cache_dir)
+    try:
+        with open(path, 'r') as f:
+            doc = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    # A cache written for another API version is as good as no cache
+    if doc.get('name') != api or doc.get('version') != version:
+        return None
+    return doc
+
+
+def save_discovery_document(doc, api=API_NAME, version=API_VERSION, cache_dir=DISCOVERY_CACHE_DIR):
+    path = discovery_cache_path(api, version, cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(doc, f)
+    os.replace(tmp_path, path)
+    logging.debug('Cached discovery document revision %s', doc.get('revision'))
+
+
+def make_http_pool(creds, size=POOL_SIZE, scheduler=None):
+    """Keep-alive pool of authorized Http objects, shared across reconnects."""
+    from httplib2 import Http
+
+    if stub_root_url():
+        return PooledHttp(Http, size, scheduler=scheduler)
+    return PooledHttp(lambda: creds.authorize(Http()), size, scheduler=scheduler)
+
+
+def build_service(creds, http=None, cache_dir=DISCOVERY_CACHE_DIR, refresh=False):
+    """Build the Sheets service, from the cached discovery document if possible.
+
+    Falls back to a normal build() (which fetches the document) when the
+    cache is missing or refresh is set, and writes the result back.
+    """
+    from googleapiclient.discovery import build, build_from_document
+
+    root_url = stub_root_url()
+    if http is None:
+        http = make_http_pool(creds)
+
+    doc = None if refresh else load_discovery_document(cache_dir=cache_dir)
+    if doc is None:
+        service = build(API_NAME, API_VERSION, http=http, cache_discovery=False)
+        doc = service._rootDesc
+        try:
+            save_discovery_document(doc, cache_dir=cache_dir)
+        except (IOError, OSError) as e:
+            logging.warning('Could not cache discovery document: %s', e)
+        if not root_url:
+            return service
+
+    if root_url:
+        doc = dict(doc, rootUrl=root_url, baseUrl=root_url + doc.get('servicePath', ''))
+    return build_from_document(doc, http=http)
+
+
+def seconds_since_boot():
+    with open('/proc/uptime', 'r') as f:
+        return float(f.read().split()[0])
+
+
+class StartupTimer:
+    def __init__(self, log_path=STARTUP_LOG, until=()):
+        self.log_path = log_path
+        # The line is written once all of these phases are marked, from
+        # whichever thread marks the last one
+        self.until = set(until)
+        self.start = time.monotonic()
+        self.marks = []
+        self._lock = threading.Lock()
+        self._written = False
+
+    def mark(self, phase):
+        elapsed = time.monotonic() - self.start
+        with self._lock:
+            self.marks.append((phase, elapsed))
+            done = (self.until and not self._written
+                    and self.until <= set(p for p, _ in self.marks))
+            if done:
+                self._written = True
+        logging.debug('Startup: %s after %.3fs', phase, elapsed)
+        if done:
+            self.write()
+        return elapsed
+
+    def write(self):
+        # One line per boot: time since kernel boot, then each phase
+        try:
+            uptime = '%.3f' % seconds_since_boot()
+        except (IOError, OSError):
+            uptime = '-'
+        fields = [time.strftime('%Y-%m-%dT%H:%M:%S'), 'uptime=' + uptime]
+        with self._lock:
+            marks = list(self.marks)
+        for phase, elapsed in marks:
+            fields.append('%s=%.3f' % (phase, elapsed))
+        with open(self.log_path, 'a') as f:
+            f.write(' '.join(fields) + '\n')
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  sheets_scheduler.py
+#  Quota-aware scheduling of every Sheets request.
+#
+#  PooledHttp hands each request to a SheetsScheduler, which lets it go
+#  once a token bucket sized to the API quota has a token and no
+#  request in a more important lane is waiting:
+#
+#    MARK        attendance writes and liveness probes
+#    READ        verification reads (sync)
+#    BACKGROUND  calendar refreshes, bulk imports
+#
+#  Callers pick the lane for the requests made on their thread:
+#
+#    with lane(MARK):
+#        request.execute()
+#
+#  A deadline() around the call also bounds the wait for quota. A
+#  send_deadline() bounds only the request itself and starts once the
+#  scheduler lets it go, for writers that would rather queue behind the
+#  quota than fail (the aggregator's batch writers):
+#
+#    with send_deadline(5), lane(MARK):
+#        request.execute()
+#
+#  A 429 empties the bucket for the Retry-After time, so every lane
+#  backs off, and the request is queued again as long as the caller's
+#  deadline allows. Otherwise the 429 is passed up; callers treat it as
+#  throttling (reconnect.is_throttled), not as a lost connection, and
+#  retry after throttled_for(). Time spent waiting in the queue is
+#  recorded per lane.
+# --------------------------------------
+import contextlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import deadline
+import metrics
+from reconnect import Throttled
+from token_bucket import USER_QUOTA, TokenBucket
+
+MARK = 0
+READ = 1
+BACKGROUND = 2
+LANE_NAMES = ('mark', 'read', 'background')
+
+# Seconds to back off after a 429 without a Retry-After header; short
+# enough that a mark (5 s deadline) still gets its retry
+DEFAULT_RETRY_AFTER = 2.0
+MAX_RETRIES = 3
+
+QUEUE_SECONDS = metrics.histogram('sheets_queue_seconds', 'Wait for quota and priority', ('lane',))
+THROTTLED = metrics.counter('sheets_throttled_total', '429 responses backed off', ('lane',))
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def lane(priority):
+    outer = getattr(_local, 'lane', READ)
+    _local.lane = priority
+    try:
+        yield
+    finally:
+        _local.lane = outer
+
+
+def current_lane():
+    return getattr(_local, 'lane', READ)
+
+
+@contextlib.contextmanager
+def send_deadline(seconds):
+    outer = getattr(_local, 'send_deadline', None)
+    _local.send_deadline = seconds
+    try:
+        yield
+    finally:
+        _local.send_deadline = outer
+
+
+def send_timed(send):
+    """Call send() under the send_deadline() set on this thread, if any."""
+    seconds = getattr(_local, 'send_deadline', None)
+    if seconds is None:
+        return send()
+    with deadline.deadline(seconds):
+        return send()
+
+
+def retry_after(resp):
+    # httplib2 lower-cases header names
+    try:
+        return max(0.0, float(resp.get('retry-after')))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+class SheetsScheduler:
+    def __init__(self, bucket=None, max_retries=MAX_RETRIES):
+        self.bucket = bucket or TokenBucket.per_minute(USER_QUOTA, burst=USER_QUOTA // 10)
+        self.max_retries = max_retries
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._tickets = itertools.count()
+        self.stats = dict((name, {'calls': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'throttled': 0})
+                          for name in LANE_NAMES)
+
+    def _wait_turn(self, priority, dl):
+        ticket = (priority, next(self._tickets))
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            self._cond.notify_all()
+            try:
+                while True:
+                    wait = None
+                    if self._queue[0] == ticket:
+                        wait = self.bucket.try_acquire()
+                        if not wait:
+                            heapq.heappop(self._queue)
+                            self._cond.notify_all()
+                            return
+                    if dl is not None:
+                        if dl.expired():
+                            # Held back for quota or a busier lane, not a lost connection
+                            raise Throttled('Deadline of %.3fs passed waiting for quota' % dl.seconds)
+                        wait = dl.remaining() if wait is None else min(wait, dl.remaining())
+                    self._cond.wait(wait)
+            except BaseException:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+                raise
+
+    def _record(self, priority, key, value=1):
+        stats = self.stats[LANE_NAMES[priority]]
+        with self._cond:
+            stats[key] += value
+            if key == 'wait_total':
+                stats['wait_max'] = max(stats['wait_max'], value)
+
+    def run(self, send):
+        """Call send() -> (resp, content) when quota and priority allow."""
+        priority = current_lane()
+        dl = deadline.current()
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            self._wait_turn(priority, dl)
+            waited = time.monotonic() - start
+            self._record(priority, 'calls')
+            self._record(priority, 'wait_total', waited)
+            QUEUE_SECONDS.labels(LANE_NAMES[priority]).observe(waited)
+            resp, content = send_timed(send)
+            if getattr(resp, 'status', None) != 429 or attempt >= self.max_retries:
+                return resp, content
+            pause = retry_after(resp)
+            self._record(priority, 'throttled')
+            THROTTLED.labels(LANE_NAMES[priority]).inc()
+            self.bucket.drain(pause)
+            logging.warning('Sheets quota hit, backing off %.1fs', pause)
+            if dl is not None and dl.remaining() < pause:
+                # Let the caller see the 429; its deadline ends first
+                return resp, content
+            attempt += 1
+
+    def throttled_for(self):
+        # Seconds to hold a throttled request back: until the bucket has a
+        # token again, and never less than a Retry-After-less 429 asks for
+        return max(self.bucket.wait_time(), DEFAULT_RETRY_AFTER)
+
+    def queued(self):
+        with self._cond:
+            return len(self._queue)
+
+    def snapshot(self):
+        with self._cond:
+            return dict((name, dict(stats)) for name, stats in self.stats.items())
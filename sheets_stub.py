@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  sheets_stub.py
+#  Local stand-in for the Google Sheets API, for offline load and
+#  latency testing.
+#
+#  Implements the endpoints the apps use:
+#    GET  /v4/spreadsheets/<id>
+#    GET  /v4/spreadsheets/<id>/values/<range>
+#    PUT  /v4/spreadsheets/<id>/values/<range>
+#    POST /v4/spreadsheets/<id>/values:batchUpdate
+#    GET  /v4/spreadsheets/<id>/values:batchGet?ranges=...
+#  plus GET /stats with request counters.
+#
+#  Latency, error rate and a per-minute quota (429 with Retry-After)
+#  are configurable, and a seeded random generator keeps runs
+#  deterministic. Point the apps at it with
+#    SHEETS_ROOT_URL=http://127.0.0.1:8089/ python3 AttendanceLoggerLKM.py
+#
+#  Usage:
+#    python3 sheets_stub.py --port 8089 --latency 0.2 --error-rate 0.05 --quota 60 --seed sheet.json
+# --------------------------------------
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlparse
+
+from sheet_range import format_range, parse_range
+
+DEFAULT_SHEET = 'Sheet1'
+
+_PATH = re.compile(r'^/v4/spreadsheets/([^/:]+)(?:/values(?:/(.+)|:(batchUpdate|batchGet)))?$')
+
+
+def user_entered(value):
+    # Numbers typed into a cell are stored as numbers
+    if isinstance(value, str):
+        for kind in (int, float):
+            try:
+                return kind(value)
+            except ValueError:
+                pass
+    return value
+
+
+class StubSheets:
+    """In-memory spreadsheets plus the fault injection settings."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, quota=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # Requests allowed per rolling minute, 0 for unlimited
+        self.quota = quota
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        # spreadsheet id -> sheet name -> {(row, col): value}
+        self.books = {}
+        self.request_times = []
+        self.stats = {}
+
+    def cells(self, spreadsheet_id, sheet):
+        book = self.books.setdefault(spreadsheet_id, {})
+        return book.setdefault(sheet or DEFAULT_SHEET, {})
+
+    def load(self, spreadsheet_id, sheets):
+        # sheets: {sheet name: [[row 1 values], [row 2 values], ...]}
+        with self.lock:
+            for sheet, rows in sheets.items():
+                cells = self.cells(spreadsheet_id, sheet)
+                for r, values in enumerate(rows):
+                    for c, value in enumerate(values):
+                        if value != '':
+                            cells[(r + 1, c + 1)] = value
+
+    def count(self, key):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def admit(self, method):
+        """Apply latency and faults; return (status, retry_after) or None."""
+        with self.lock:
+            self.count(method)
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            failed = self.random.random() < self.error_rate
+            now = time.time()
+            self.request_times = [t for t in self.request_times if now - t < 60]
+            if self.quota and len(self.request_times) >= self.quota:
+                self.count('429')
+                return 429, int(61 - (now - self.request_times[0]))
+            self.request_times.append(now)
+        time.sleep(delay)
+        if failed:
+            with self.lock:
+                self.count('500')
+            return 500, None
+        return None
+
+    def get(self, spreadsheet_id, a1):
+        sheet, first_row, first_col, last_row, last_col = parse_range(a1)
+        with self.lock:
+            cells = self.cells(spreadsheet_id, sheet)
+            in_range = [(r, c) for (r, c) in cells
+                        if r >= first_row and c >= first_col
+                        and (last_row is None or r <= last_row) and (last_col is None or c <= last_col)]
+            values = []
+            if in_range:
+                max_row = max(r for r, _ in in_range)
+                for r in range(first_row, max_row + 1):
+                    row_cells = [c for (rr, c) in in_range if rr == r]
+                    if not row_cells:
+                        values.append([])
+                        continue
+                    values.append([cells.get((r, c), '') for c in range(first_col, max(row_cells) + 1)])
+        result = {'range': a1, 'majorDimension': 'ROWS'}
+        if values:
+            result['values'] = values
+        return result
+
+    def update(self, spreadsheet_id, a1, values, value_input_option):
+        sheet, first_row, first_col, _, _ = parse_range(a1)
+        updated = 0
+        last_col = first_col
+        with self.lock:
+            cells = self.cells(spreadsheet_id, sheet)
+            for r, row_values in enumerate(values):
+                for c, value in enumerate(row_values):
+                    if value_input_option == 'USER_ENTERED':
+                        value = user_entered(value)
+                    key = (first_row + r, first_col + c)
+                    if value in ('', None):
+                        cells.pop(key, None)
+                    else:
+                        cells[key] = value
+                    updated += 1
+                    last_col = max(last_col, first_col + c)
+        last_row = first_row + max(len(values), 1) - 1
+        return {'spreadsheetId': spreadsheet_id,
+                'updatedRange': format_range(sheet or DEFAULT_SHEET, first_row, first_col, last_row, last_col),
+                'updatedRows': len(values),
+                'updatedColumns': last_col - first_col + 1,
+                'updatedCells': updated}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API, so client connection reuse shows up
+    protocol_version = 'HTTP/1.1'
+    # Set on the server class by make_server()
+    sheets = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, message, reason, headers=None):
+        self._reply(status, {'error': {'code': status, 'message': message, 'status': reason}}, headers)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _route(self, http_method):
+        url = urlparse(self.path)
+        # Always drain the body so a kept-alive connection stays in sync
+        body = self._body() if http_method in ('PUT', 'POST') else {}
+        if url.path == '/stats' and http_method == 'GET':
+            with self.sheets.lock:
+                self._reply(200, dict(self.sheets.stats))
+            return
+        match = _PATH.match(url.path)
+        if match is None:
+            self._error(404, 'Not found: ' + url.path, 'NOT_FOUND')
+            return
+        spreadsheet_id, a1, batch = match.groups()
+        query = parse_qs(url.query)
+
+        if batch:
+            method = 'values.' + batch
+        elif a1:
+            method = 'values.get' if http_method == 'GET' else 'values.update'
+        else:
+            method = 'get'
+
+        fault = self.sheets.admit(method)
+        if fault is not None:
+            status, retry_after = fault
+            if status == 429:
+                self._error(429, 'Quota exceeded', 'RESOURCE_EXHAUSTED', {'Retry-After': str(retry_after)})
+            else:
+                self._error(status, 'Injected backend error', 'INTERNAL')
+            return
+
+        try:
+            if method == 'get' and http_method == 'GET':
+                self._reply(200, {'spreadsheetId': spreadsheet_id})
+            elif method == 'values.get' and http_method == 'GET':
+                self._reply(200, self.sheets.get(spreadsheet_id, unquote(a1)))
+            elif method == 'values.update' and http_method == 'PUT':
+                option = query.get('valueInputOption', ['RAW'])[0]
+                self._reply(200, self.sheets.update(spreadsheet_id, unquote(a1), body.get('values', []), option))
+            elif method == 'values.batchUpdate' and http_method == 'POST':
+                option = body.get('valueInputOption', 'RAW')
+                responses = [self.sheets.update(spreadsheet_id, data['range'], data.get('values', []), option)
+                             for data in body.get('data', [])]
+                self._reply(200, {'spreadsheetId': spreadsheet_id,
+                                  'totalUpdatedCells': sum(r['updatedCells'] for r in responses),
+                                  'responses': responses})
+            elif method == 'values.batchGet' and http_method == 'GET':
+                ranges = query.get('ranges', [])
+                self._reply(200, {'spreadsheetId': spreadsheet_id,
+                                  'valueRanges': [self.sheets.get(spreadsheet_id, r) for r in ranges]})
+            else:
+                self._error(405, 'Method not allowed', 'INVALID_ARGUMENT')
+        except (ValueError, KeyError) as e:
+            self._error(400, str(e), 'INVALID_ARGUMENT')
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_PUT(self):
+        self._route('PUT')
+
+    def do_POST(self):
+        self._route('POST')
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up after a timeout are expected under test
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+
+def make_server(sheets, host='127.0.0.1', port=8089):
+    handler = type('BoundStubHandler', (StubHandler,), {'sheets': sheets})
+    return StubServer((host, port), handler)
+
+
+def serve_in_thread(sheets, host='127.0.0.1', port=0):
+    """Start a stub server on a background thread; returns (server, root_url)."""
+    server = make_server(sheets, host, port)
+    thread = threading.Thread(target=server.serve_forever, name='sheets-stub')
+    thread.daemon = True
+    thread.start()
+    return server, 'http://%s:%d/' % server.server_address
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Google Sheets API stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds of random latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with 500')
+    parser.add_argument('--quota', type=int, default=0, help='requests per minute before 429s, 0 = unlimited')
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('--seed', help='JSON file: {spreadsheet id: {sheet name: [[row values], ...]}}')
+    args = parser.parse_args()
+
+    sheets = StubSheets(args.latency, args.jitter, args.error_rate, args.quota, args.random_seed)
+    if args.seed:
+        with open(args.seed, 'r') as f:
+            for spreadsheet_id, book in json.load(f).items():
+                sheets.load(spreadsheet_id, book)
+
+    server = make_server(sheets, args.host, args.port)
+    print('Sheets stand-in on http://%s:%d/' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
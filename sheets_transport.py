@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  sheets_transport.py
+#  Keep-alive connection pool for the Sheets client.
+#
+#  PooledHttp looks like an httplib2.Http to googleapiclient (it only
+#  needs request()), but hands every request to one of a small, fixed
+#  number of authorized Http objects. Each of those keeps its TCP/TLS
+#  connection to the API host open between requests, so after the
+#  first request an update costs a single round trip. Pooled objects
+#  also make the service safe to use from several threads, which a
+#  single httplib2.Http is not.
+#
+#  Idle connections are health checked before reuse: a socket the
+#  server has closed (readable at EOF) or one idle for longer than the
+#  server keeps it is closed, and httplib2 reconnects on the next
+#  request instead of failing it.
+#
+#  A deadline.deadline() set by the caller bounds the wait for a pooled
+#  object and becomes the socket timeout of the request. With a
+#  scheduler, requests are paced to the API quota before they are sent
+#  (see sheets_scheduler.send_deadline for a deadline that starts then).
+# --------------------------------------
+import logging
+import select
+import threading
+import time
+from urllib.parse import urlparse
+
+import deadline
+import metrics
+from sheets_scheduler import send_timed
+
+POOL_SIZE = 2
+# Google front ends drop idle keep-alive connections after a few minutes
+IDLE_TIMEOUT = 120
+
+SHEETS_REQUESTS = metrics.counter('sheets_requests_total', 'Sheets API requests', ('method', 'status'))
+SHEETS_SECONDS = metrics.histogram('sheets_request_seconds', 'Sheets API round trip', ('method',))
+
+
+def api_method(uri, verb):
+    # ".../values:batchUpdate" -> "values.batchUpdate", ".../values/A1" + PUT -> "values.update"
+    path = urlparse(uri).path
+    if ':' in path.rsplit('/', 1)[-1]:
+        return path.rsplit('/', 1)[-1].replace(':', '.')
+    if '/values/' in path:
+        return 'values.update' if verb == 'PUT' else 'values.get'
+    return 'get'
+
+
+def _connections(http):
+    # oauth2client patches Http in place; google-auth wraps it in .http
+    return getattr(getattr(http, 'http', http), 'connections', {})
+
+
+class PooledHttp:
+    def __init__(self, factory, size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT, scheduler=None):
+        # factory() returns a new authorized httplib2.Http
+        self.factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        # Optional SheetsScheduler every request is queued through
+        self.scheduler = scheduler
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._created = 0
+        self.stats = {'requests': 0, 'reused': 0, 'pruned': 0, 'created': 0}
+
+    def _acquire(self, dl):
+        with self._cond:
+            self.stats['requests'] += 1
+            while not self._idle and self._created >= self.size:
+                if dl is None:
+                    self._cond.wait()
+                else:
+                    dl.check()
+                    self._cond.wait(dl.remaining())
+            if self._idle:
+                http, last_used = self._idle.pop()
+                self._check(http, last_used)
+                return http
+            self._created += 1
+            self.stats['created'] += 1
+        return self.factory()
+
+    def _release(self, http):
+        with self._cond:
+            self._idle.append((http, time.monotonic()))
+            self._cond.notify()
+
+    def _check(self, http, last_used):
+        idle_for = time.monotonic() - last_used
+        for conn in _connections(http).values():
+            sock = getattr(conn, 'sock', None)
+            if sock is None:
+                continue
+            try:
+                # An idle keep-alive socket should have nothing to read;
+                # readable means the server closed it
+                dead = bool(select.select([sock], [], [], 0)[0])
+            except (ValueError, OSError):
+                dead = True
+            if dead or idle_for > self.idle_timeout:
+                conn.close()
+                self.stats['pruned'] += 1
+            else:
+                self.stats['reused'] += 1
+
+    def _close(self, http):
+        for conn in _connections(http).values():
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _set_timeout(self, http, seconds):
+        # New connections take Http.timeout; open ones need the socket set
+        getattr(http, 'http', http).timeout = seconds
+        for conn in _connections(http).values():
+            conn.timeout = seconds
+            sock = getattr(conn, 'sock', None)
+            if sock is not None:
+                sock.settimeout(seconds)
+
+    def request(self, *args, **kwargs):
+        if self.scheduler is not None:
+            return self.scheduler.run(lambda: self._request(*args, **kwargs))
+        return send_timed(lambda: self._request(*args, **kwargs))
+
+    def _request(self, *args, **kwargs):
+        uri = args[0] if args else kwargs.get('uri', '')
+        method = api_method(uri, args[1] if len(args) > 1 else kwargs.get('method', 'GET'))
+        dl = deadline.current()
+        http = self._acquire(dl)
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            if dl is not None:
+                dl.check()
+                self._set_timeout(http, dl.remaining())
+            else:
+                self._set_timeout(http, None)
+            resp, content = http.request(*args, **kwargs)
+            status = getattr(resp, 'status', 'unknown')
+            return resp, content
+        except Exception:
+            # Do not hand a half-used connection to the next request
+            self._close(http)
+            raise
+        finally:
+            SHEETS_SECONDS.labels(method).observe(time.perf_counter() - start)
+            SHEETS_REQUESTS.labels(method, status).inc()
+            self._release(http)
+
+    def close(self):
+        with self._cond:
+            for http, _ in self._idle:
+                self._close(http)
+        logging.debug('HTTP pool closed: %s', self.stats)
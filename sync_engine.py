@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  sync_engine.py
+#  Delta sync between the local AttendanceStore and the sheet.
+#
+#  Each cycle reads the whole attendance block with one
+#  values.batchGet, compares it three ways against the local store and
+#  the sheet as it was at the last sync (the base), and pushes the cells
+#  that only changed locally in one batchUpdate:
+#
+#    local == base, sheet != base   edited by hand: taken into the store
+#    local != base, sheet == base   changed here: pushed to the sheet
+#    both changed, same value       already in sync
+#    both changed, different value  conflict, settled by the policy
+#
+#  Cells with marks still waiting in the journal are left alone; the
+#  replayer is already sending them. A cycle costs one read and at most
+#  one write, instead of a read-back after every press.
+#
+#  Marks made here reach the store through record_local(), under the
+#  same lock as the merge. The lock is never held across the network,
+#  so a press never waits on a sync cycle's read.
+# --------------------------------------
+import logging
+import threading
+
+from deadline import deadline
+from sheets_scheduler import READ, lane
+from sheet_range import parse_cell, parse_range
+
+SYNC_INTERVAL = 300
+SYNC_TIMEOUT = 10
+# Conflict policies: whose value wins when both sides changed a cell
+PREFER_SHEET = 'sheet'
+PREFER_LOCAL = 'local'
+
+
+class SyncEngine:
+    def __init__(self, service, spreadsheet_id, store, replayer, sheet=None,
+                 prefer=PREFER_SHEET, interval=SYNC_INTERVAL, timeout=SYNC_TIMEOUT):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.store = store
+        # Local wins are written through the journal like any other mark
+        self.replayer = replayer
+        self.sheet = sheet
+        self.prefer = prefer
+        self.interval = interval
+        self.timeout = timeout
+        # Optional gate() -> bool; cycles are skipped while it is False
+        self.gate = None
+
+        # The sheet as of the last sync; None until the first one
+        self.base = None
+        self.stats = {'cycles': 0, 'pulled': 0, 'pushed': 0, 'conflicts': 0}
+        # _lock guards store and base; _cycle_lock keeps cycles one at a time
+        self._lock = threading.Lock()
+        self._cycle_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def _pull(self, block):
+        with deadline(self.timeout), lane(READ):
+            result = self.service.spreadsheets().values().batchGet(spreadsheetId=self.spreadsheet_id,
+                                                                   ranges=[block],
+                                                                   valueRenderOption='UNFORMATTED_VALUE').execute()
+        value_ranges = result.get('valueRanges', [])
+        return value_ranges[0].get('values', []) if value_ranges else []
+
+    def _pending_cells(self):
+        return set(entry.cell_range for entry in self.replayer.journal.pending())
+
+    def sync(self):
+        """Run one sync cycle; returns the number of cells pushed."""
+        with self._cycle_lock:
+            with self._lock:
+                store = self.store
+                block = store.block_range(self.sheet)
+            if block is None:
+                return 0
+            _, first_row, first_col, last_row, _ = parse_range(block)
+            values = self._pull(block)
+            with self._lock:
+                if self.store is not store:
+                    # Replaced while we read; the next cycle starts over
+                    return 0
+                push = self._merge(values, first_row, first_col, last_row)
+
+            for cell, value in push:
+                self.replayer.record(cell, value)
+            if push:
+                # Send the whole delta now as one batchUpdate
+                self.replayer.batch_writer.flush()
+            logging.debug('Sync cycle: %s', self.stats)
+            return len(push)
+
+    def _merge(self, values, first_row, first_col, last_row):
+        # Called with _lock held; returns the (cell, value) pairs to push
+        store = self.store
+        self.stats['cycles'] += 1
+        if self.base is None:
+            # First cycle: treat everything here as unchanged, so the
+            # sheet fills in the store (journaled marks excepted)
+            self.base = store.copy()
+        for row in store.rows[len(self.base.rows):]:
+            self.base.add_lesson(row)
+        remote = self.base.copy()
+        remote.load_block(values, first_row, first_col, last_row)
+
+        pending = self._pending_cells()
+        cells = set(self.base.changed_cells(store)) | set(self.base.changed_cells(remote))
+        push = []
+        for student, lesson in sorted(cells):
+            cell = store.cell(student, lesson)
+            base = self.base.is_marked(student, lesson)
+            local = store.is_marked(student, lesson)
+            sheet = remote.is_marked(student, lesson)
+            if cell in pending or local == sheet:
+                continue
+            if local == base:
+                pull = True
+            elif sheet == base:
+                pull = False
+            else:
+                self.stats['conflicts'] += 1
+                pull = self.prefer == PREFER_SHEET
+                logging.warning('Sync conflict on %s, keeping the %s value', cell,
+                                'sheet' if pull else 'local')
+            if pull:
+                store.set(student, lesson, sheet)
+                self.stats['pulled'] += 1
+            else:
+                push.append((cell, int(local)))
+
+        self.base = remote
+        self.stats['pushed'] += len(push)
+        return push
+
+    def record_local(self, cell_range, present):
+        """Mirror a mark made on this device into the store."""
+        cell_row, cell_col = parse_cell(cell_range)
+        with self._lock:
+            student = self.store.student_for_column(cell_col)
+            lesson = self.store.add_lesson(cell_row)
+            if student is not None:
+                self.store.set(student, lesson, present)
+
+    def add_lessons(self, rows):
+        with self._lock:
+            for row in rows:
+                self.store.add_lesson(row)
+
+    def replace_store(self, store):
+        """Sync into a new store (e.g. for a new roster) from now on."""
+        with self._lock:
+            self.store = store
+            # The next cycle starts over and fills the store from the sheet
+            self.base = None
+
+    def kick(self):
+        self._wake.set()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='sync')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self._running or (self.gate is not None and not self.gate()):
+                continue
+            try:
+                self.sync()
+            except Exception as e:
+                logging.warning('Sync failed: %s', e)
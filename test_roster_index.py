@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  test_roster_index.py
+#  Regression tests for roster_index.RosterIndex.
+#
+#  Usage:
+#    python3 -m unittest test_roster_index
+# --------------------------------------
+import unittest
+
+from roster_index import RosterIndex
+
+
+class RosterIndexTest(unittest.TestCase):
+    def test_full_name_beats_longer_names_sharing_it(self):
+        # "Leo" is also a word of "Leo Fang"; the exact name still wins
+        index = RosterIndex(['Leo Fang', 'Leo', 'Nathan Zhang'])
+        self.assertEqual(index.resolve('Leo'), ('Leo', ['Leo']))
+        self.assertEqual(index.resolve('leo fang'), ('Leo Fang', ['Leo Fang']))
+
+    def test_prefix_narrows_by_later_words(self):
+        index = RosterIndex(['Nathan Zhang', 'Nathan Yu', 'Jeremy Lo'])
+        self.assertEqual(index.resolve('nat z'), ('Nathan Zhang', ['Nathan Zhang']))
+        self.assertEqual(index.resolve('nat')[0], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# --------------------------------------
+#  token_bucket.py
+#  Thread-safe token bucket for pacing Sheets requests.
+#
+#  The Sheets API allows a fixed number of requests per minute per user
+#  (60) and per project (300). A bucket refills at quota / 60 tokens a
+#  second up to its capacity, so short bursts go straight through and
+#  sustained load is held just under the quota instead of running into
+#  429s.
+# --------------------------------------
+import threading
+import time
+
+# Sheets write requests per minute per user per project
+USER_QUOTA = 60
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        # rate: tokens per second; capacity: largest burst
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.clock = clock
+        self.tokens = self.capacity
+        self._stamp = clock()
+        self._cond = threading.Condition()
+
+    @classmethod
+    def per_minute(cls, quota, burst=None):
+        return cls(quota / 60.0, burst)
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available; else return the seconds to wait."""
+        with self._cond:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def wait_time(self, tokens=1):
+        """Seconds until tokens are available, without taking them."""
+        with self._cond:
+            self._refill()
+            return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def drain(self, seconds=0.0):
+        # Empty the bucket, e.g. after a 429, so nothing is sent for at
+        # least seconds (Retry-After) plus the time to earn one token
+        with self._cond:
+            self._refill()
+            self.tokens = min(0.0, self.tokens) - seconds * self.rate